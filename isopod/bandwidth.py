@@ -0,0 +1,128 @@
+import datetime
+import logging
+from dataclasses import dataclass
+from typing import Optional, Sequence
+
+log = logging.getLogger(__name__)
+
+# Only sends at least this large say anything useful about the uplink, since
+# connection setup and rsync's file list dominate smaller ones.
+MIN_SAMPLE_BYTES = 64 * (1024**2)
+CAPACITY_SMOOTHING = 0.3
+
+
+@dataclass(frozen=True)
+class Window:
+    """
+    A daily span of local time, which wraps past midnight if it ends before it
+    starts.
+    """
+
+    start: datetime.time
+    end: datetime.time
+
+    @classmethod
+    def parse(cls, spec: str) -> "Window":
+        """Parse a window of the form ``HH:MM-HH:MM``."""
+        start, sep, end = spec.partition("-")
+        if not sep:
+            raise ValueError(f"window must look like HH:MM-HH:MM: {spec!r}")
+        window = cls(
+            datetime.time.fromisoformat(start.strip()),
+            datetime.time.fromisoformat(end.strip()),
+        )
+        if window.start == window.end:
+            raise ValueError(f"window must not be empty: {spec!r}")
+        return window
+
+    def contains(self, t: datetime.time) -> bool:
+        if self.start < self.end:
+            return self.start <= t < self.end
+        return t >= self.start or t < self.end
+
+    def seconds_until_edge(self, now: datetime.datetime) -> float:
+        """The number of seconds until this window next opens or closes."""
+        return min(_seconds_until(now, self.start), _seconds_until(now, self.end))
+
+
+class BandwidthPolicy:
+    """
+    Decides how fast sends may run at a given time.
+
+    Outside of full-speed windows, the total rate of all sends is capped at
+    ``limit``, and (when ``capacity_fraction`` is set) at that fraction of the
+    uplink throughput measured by unlimited sends. Until a measurement exists,
+    only the fixed limit applies.
+
+    Rates are in KiB per second, like rsync's ``--bwlimit``.
+
+    :param limit: The fixed cap on total send rate, if any
+    :param windows: Times of day when sends run at full speed
+    :param capacity_fraction: The share of measured throughput that sends may
+        use outside of windows, if any
+    """
+
+    def __init__(
+        self,
+        limit: Optional[int] = None,
+        windows: Sequence[Window] = (),
+        capacity_fraction: Optional[float] = None,
+    ):
+        assert limit is None or limit > 0, "limit must be positive"
+        assert capacity_fraction is None or 0 < capacity_fraction <= 1
+        self.limit = limit
+        self.windows = tuple(windows)
+        self.capacity_fraction = capacity_fraction
+        self.capacity: Optional[float] = None
+
+    def total_limit(self, now: datetime.datetime) -> Optional[float]:
+        """The cap on the total rate of all sends at ``now``, if any."""
+        if any(window.contains(now.time()) for window in self.windows):
+            return None
+
+        limits = []
+        if self.limit is not None:
+            limits.append(self.limit)
+        if self.capacity_fraction is not None and self.capacity is not None:
+            limits.append(self.capacity_fraction * self.capacity)
+        return min(limits, default=None)
+
+    def transfer_limit(self, now: datetime.datetime, slots: int) -> Optional[int]:
+        """
+        The ``--bwlimit`` for one of ``slots`` concurrent sends at ``now``, if
+        any. Every slot gets an equal share whether or not it's in use, so that
+        starting a send never pushes the others over the cap.
+        """
+
+        if (total := self.total_limit(now)) is None:
+            return None
+        return max(1, int(total / slots))
+
+    def seconds_until_change(self, now: datetime.datetime) -> Optional[float]:
+        """The number of seconds until the next window opens or closes, if any."""
+        return min(
+            (window.seconds_until_edge(now) for window in self.windows), default=None
+        )
+
+    def record(self, size: int, elapsed: float):
+        """
+        Account for an unlimited send of ``size`` bytes, made while nothing else
+        was sending, in the capacity estimate.
+        """
+
+        if size < MIN_SAMPLE_BYTES or elapsed <= 0:
+            return
+
+        rate = size / 1024 / elapsed
+        if self.capacity is None:
+            self.capacity = rate
+        else:
+            self.capacity += CAPACITY_SMOOTHING * (rate - self.capacity)
+        log.info("Estimated uplink capacity: %d KiB/s", self.capacity)
+
+
+def _seconds_until(now: datetime.datetime, t: datetime.time) -> float:
+    target = datetime.datetime.combine(now.date(), t, tzinfo=now.tzinfo)
+    if target <= now:
+        target += datetime.timedelta(days=1)
+    return (target - now).total_seconds()
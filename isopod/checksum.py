@@ -0,0 +1,113 @@
+import logging
+from hashlib import file_digest, sha256
+from threading import Condition
+from typing import BinaryIO, Optional
+
+from isopod.controller import ThreadJob
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024**2
+
+
+class PrefixHasher(ThreadJob):
+    """
+    Computes the SHA-256 digest of a file while another process is still
+    writing it, by hashing each part of the file as soon as it is known to be
+    final. Data is read back shortly after it lands, while it's still in the
+    page cache, so that the digest doesn't cost a second full read of the
+    file from storage.
+
+    The reading happens in a background thread, so that callers never wait on
+    it. Exits with status 0 once :meth:`finish` has been called and the whole
+    file is hashed.
+
+    :param path: The file to hash
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.offset = 0
+        self.hexdigest: Optional[str] = None
+        super().__init__(f"Hashing {path}")
+
+        self._end = 0
+        self._finishing = False
+        self._digest = sha256()
+        self._cond = Condition()
+        self._start()
+
+    def update(self, end: int):
+        """Let the file be hashed up to ``end``, which must not go backwards."""
+        with self._cond:
+            if end > self._end:
+                self._end = end
+                self._cond.notify()
+
+    def finish(self):
+        """
+        Let the rest of the file be hashed. Once the hasher exits, the digest
+        of all of it is in ``hexdigest``.
+        """
+
+        with self._cond:
+            self._finishing = True
+            self._cond.notify()
+
+    def terminate(self):
+        super().terminate()
+        with self._cond:
+            self._cond.notify()
+
+    def _work(self) -> int:
+        f: Optional[BinaryIO] = None
+        try:
+            while True:
+                with self._cond:
+                    self._cond.wait_for(
+                        lambda: self._stop.is_set()
+                        or self._finishing
+                        or self.offset < self._end
+                    )
+                    if self._stop.is_set():
+                        return -15
+                    end = None if self._finishing else self._end
+
+                # The file may not exist until the writer gets going.
+                if f is None:
+                    f = open(self.path, "rb")
+                    f.seek(self.offset)
+                size = CHUNK_SIZE if end is None else min(CHUNK_SIZE, end - self.offset)
+                if not (chunk := f.read(size)):
+                    if end is None:
+                        break
+                    # The writer hasn't actually written this far yet, so try
+                    # again on the next update.
+                    with self._cond:
+                        if self._end == end:
+                            self._end = self.offset
+                    continue
+                self._digest.update(chunk)
+                self.offset += len(chunk)
+        finally:
+            if f is not None:
+                f.close()
+
+        self.hexdigest = self._digest.hexdigest()
+        return 0
+
+
+def hash_file(path: str) -> str:
+    """Return the hex SHA-256 digest of the file at ``path``."""
+    with open(path, "rb") as f:
+        return file_digest(f, sha256).hexdigest()
+
+
+def sidecar_path(path: str) -> str:
+    return f"{path}.sha256"
+
+
+def write_sidecar(path: str, hexdigest: str):
+    """Write a file next to ``path`` in the format that ``sha256sum -c`` reads."""
+    with open(sidecar_path(path), "w", encoding="utf8") as f:
+        f.write(f"{hexdigest}  {path}\n")
@@ -0,0 +1,214 @@
+import logging
+import os
+import shutil
+import zlib
+from dataclasses import dataclass, field
+from hashlib import sha256
+from typing import BinaryIO, Iterator, Optional
+
+from sqlalchemy import select
+
+from isopod import db
+from isopod.controller import ThreadJob
+
+log = logging.getLogger(__name__)
+
+# Chunk boundaries fall between 2 KiB sectors, since the files on a disc start
+# on sector boundaries and identical files should produce identical chunks
+# wherever they sit. A sector ends a chunk when its CRC-32 has its low bits
+# clear, which gives chunks of about 1 MiB on average.
+SECTOR_SIZE = 2048
+MIN_CHUNK_SECTORS = 64
+MAX_CHUNK_SECTORS = 4096
+BOUNDARY_MASK = (1 << 9) - 1
+READ_SIZE = 1024**2
+
+# New chunks are checked against the chunk index in batches of about this many
+# bytes, each in a session of its own, since a session held open for a whole
+# split would keep SQLite from checkpointing the WAL past its snapshot.
+LOOKUP_BATCH_BYTES = 32 * (1024**2)
+
+MANIFEST_HEADER = "# isopod manifest v1"
+
+
+# Within a staging directory, and on the target, every chunk lives under
+# chunks/ and every manifest under manifests/. rsync sends files in sorted
+# order, so a disc's manifest only lands after all of its chunks.
+
+
+def chunks_dir(base: str) -> str:
+    return os.path.join(base, "chunks")
+
+
+def manifests_dir(base: str) -> str:
+    return os.path.join(base, "manifests")
+
+
+def chunk_path(chunks: str, digest: str) -> str:
+    return os.path.join(chunks, digest[:2], digest)
+
+
+def manifest_name(path: str) -> str:
+    return f"{os.path.basename(path)}.manifest"
+
+
+def staging_path(path: str) -> str:
+    return f"{path}.chunks"
+
+
+def split_chunks(f: BinaryIO) -> Iterator[bytes]:
+    """Split a file into content-defined chunks on sector boundaries."""
+
+    chunk = bytearray()
+    sectors = 0
+    while buf := f.read(READ_SIZE):
+        view = memoryview(buf)
+        for start in range(0, len(view), SECTOR_SIZE):
+            sector = view[start : start + SECTOR_SIZE]
+            chunk += sector
+            sectors += 1
+            if sectors < MIN_CHUNK_SECTORS:
+                continue
+            if sectors >= MAX_CHUNK_SECTORS or zlib.crc32(sector) & BOUNDARY_MASK == 0:
+                yield bytes(chunk)
+                chunk.clear()
+                sectors = 0
+    if chunk:
+        yield bytes(chunk)
+
+
+@dataclass
+class ChunkStats:
+    """
+    :param chunks: The number of chunks in the ISO
+    :param new: The digests and sizes of chunks the target doesn't have yet
+    """
+
+    chunks: int = 0
+    new: dict[str, int] = field(default_factory=dict)
+
+    @property
+    def new_bytes(self) -> int:
+        return sum(self.new.values())
+
+
+class ChunkJob(ThreadJob):
+    """
+    Splits an ISO into chunks in a background thread, staging the chunks that
+    the chunk index doesn't list as sent, along with a manifest of every chunk
+    in order. Exits with status 0 on success.
+
+    :param path: The ISO to split
+    :param staging: The directory to stage chunks and the manifest in
+    :param sha256: The SHA-256 of the whole ISO, to record in the manifest
+    """
+
+    def __init__(self, path: str, staging: str, sha256: Optional[str] = None):
+        self.path = path
+        self.staging = staging
+        self.sha256 = sha256
+        self.stats = ChunkStats()
+        super().__init__(f"Chunking {path}")
+        self._start()
+
+    def _work(self) -> int:
+        chunks = chunks_dir(self.staging)
+        size = os.path.getsize(self.path)
+        name = os.path.basename(self.path)
+        lines = [f"{MANIFEST_HEADER} {size} {self.sha256 or '-'} {name}"]
+
+        pending: dict[str, bytes] = {}
+        pending_bytes = 0
+        with open(self.path, "rb") as f:
+            for chunk in split_chunks(f):
+                if self._stop.is_set():
+                    return -15
+
+                digest = sha256(chunk).hexdigest()
+                lines.append(f"{digest} {len(chunk)}")
+                self.stats.chunks += 1
+                if digest in self.stats.new or digest in pending:
+                    continue
+
+                pending[digest] = chunk
+                pending_bytes += len(chunk)
+                if pending_bytes >= LOOKUP_BATCH_BYTES:
+                    self._stage_unsent(chunks, pending)
+                    pending.clear()
+                    pending_bytes = 0
+        self._stage_unsent(chunks, pending)
+
+        os.makedirs(manifests_dir(self.staging), exist_ok=True)
+        manifest = os.path.join(manifests_dir(self.staging), manifest_name(self.path))
+        with open(manifest, "w", encoding="utf8") as out:
+            out.write("\n".join(lines) + "\n")
+        return 0
+
+    def _stage_unsent(self, chunks: str, pending: dict[str, bytes]):
+        """Stage the chunks in ``pending`` that the chunk index doesn't list."""
+        if not pending:
+            return
+        with db.Session() as session:
+            sent = set(
+                session.execute(
+                    select(db.Chunk.digest).where(db.Chunk.digest.in_(pending.keys()))
+                ).scalars()
+            )
+
+        for digest, chunk in pending.items():
+            if digest in sent:
+                continue
+            self.stats.new[digest] = len(chunk)
+            dest = chunk_path(chunks, digest)
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            with open(dest, "wb") as out:
+                out.write(chunk)
+
+
+def record_sent(path: str, stats: ChunkStats):
+    """Add chunks that were sent for the ISO at ``path`` to the chunk index."""
+    with db.Session() as session:
+        existing = set(
+            session.execute(
+                select(db.Chunk.digest).where(db.Chunk.digest.in_(stats.new.keys()))
+            ).scalars()
+        )
+        for digest, size in stats.new.items():
+            if digest not in existing:
+                session.add(db.Chunk(digest=digest, size=size, first_disc=path))
+        session.commit()
+
+
+def remove_staging(staging: str):
+    shutil.rmtree(staging, ignore_errors=True)
+
+
+def reassemble(manifest: str, chunks: str, output: str):
+    """
+    Rebuild an ISO from a manifest and a directory of chunks, checking the
+    SHA-256 recorded in the manifest if there is one.
+
+    :raises ValueError: if the manifest is malformed or the ISO doesn't match
+    """
+
+    with open(manifest, encoding="utf8") as f:
+        header, *entries = f.read().splitlines()
+    if not header.startswith(MANIFEST_HEADER):
+        raise ValueError(f"{manifest} is not an isopod manifest")
+    size, expected, _ = header.removeprefix(MANIFEST_HEADER).split(maxsplit=2)
+
+    digest = sha256()
+    with open(output, "wb") as out:
+        for entry in entries:
+            chunk_digest, _ = entry.split()
+            with open(chunk_path(chunks, chunk_digest), "rb") as f:
+                data = f.read()
+            if sha256(data).hexdigest() != chunk_digest:
+                raise ValueError(f"Chunk {chunk_digest} is corrupt")
+            out.write(data)
+            digest.update(data)
+
+        if out.tell() != int(size):
+            raise ValueError(f"Expected {size} bytes, wrote {out.tell()}")
+    if expected != "-" and digest.hexdigest() != expected:
+        raise ValueError(f"SHA-256 of {output} does not match the manifest")
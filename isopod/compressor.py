@@ -0,0 +1,160 @@
+import logging
+import os.path
+import shlex
+from dataclasses import dataclass
+from subprocess import DEVNULL, Popen
+from typing import Optional
+
+from sqlalchemy import select
+
+import isopod.os
+from isopod import db
+from isopod.controller import Controller, EventSet, Reconciled, Result
+from isopod.space import SpaceLedger
+
+log = logging.getLogger(__name__)
+
+# Until a compression finishes, assume the next ISO shrinks by this much when
+# reserving space for its compressed copy. Afterward, assume each disc will
+# compress a little worse than the last.
+INITIAL_RATIO = 1.0
+RATIO_MARGIN = 1.1
+
+
+def compressed_path(path: str) -> str:
+    return f"{path}.zst"
+
+
+@dataclass
+class Compression:
+    """A zstd process compressing a disc's ISO to ``output``."""
+
+    disc: db.Disc
+    proc: Popen
+    output: str
+
+
+class Compressor(Controller):
+    """
+    Compresses ripped ISOs with zstd before they are sent, one at a time, so
+    that discs waiting to be sent take up less of the workdir. A disc that
+    can't be compressed, for lack of space or any other reason, is sent as is.
+
+    :param space: The ledger to reserve space for compressed copies from
+    :param level: The zstd compression level
+    :param threads: The number of zstd worker threads, or 0 for one per core
+    """
+
+    def __init__(self, space: SpaceLedger, level: int = 3, threads: int = 0):
+        super().__init__()
+        self.space = space
+        self.level = level
+        self.threads = threads
+
+        self.on_compressed = EventSet()
+
+        self._compression: Optional[Compression] = None
+        self._ratio = INITIAL_RATIO
+
+        self.poll()
+
+    def reconcile(self) -> Result:
+        if self._compression is not None:
+            match self._compression.proc.poll():
+                case None:
+                    return Reconciled()
+                case 0:
+                    self._finalize_success(self._compression)
+                case returncode:
+                    self._finalize_failure(self._compression, returncode)
+            self._compression = None
+
+        if (disc := self._get_next_disc()) is None:
+            return Reconciled()
+
+        output = compressed_path(disc.path)
+        size = os.path.getsize(disc.path)
+        estimate = int(size * self._ratio)
+        if not self.space.try_reserve(output, estimate, keep_free=0):
+            log.info("Not enough space to compress %s, sending as is", disc.path)
+            self._mark_sendable(disc)
+            self.poll()
+            return Reconciled()
+
+        args = [
+            "zstd",
+            "--quiet",
+            "--force",
+            f"-{self.level}",
+            f"-T{self.threads}",
+            "-o",
+            output,
+            disc.path,
+        ]
+        proc = Popen(args, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+        self._compression = Compression(disc=disc, proc=proc, output=output)
+        self.poll_on_exit(proc)
+        log.info("Started: %s", shlex.join(args))
+        return Reconciled()
+
+    def cleanup(self):
+        if (compression := self._compression) is None:
+            return
+
+        log.info("Canceling compression of %s", compression.disc.path)
+        compression.proc.terminate()
+        compression.proc.wait()
+        isopod.os.force_unlink(compression.output)
+        self.space.release(compression.output)
+
+    def _finalize_success(self, compression: Compression):
+        disc = compression.disc
+        size = os.path.getsize(disc.path)
+        compressed_size = os.path.getsize(compression.output)
+        ratio = compressed_size / max(size, 1)
+        self._ratio = min(INITIAL_RATIO, ratio * RATIO_MARGIN)
+        log.info(
+            "Compressed %s to %d bytes (%0.1f%%)",
+            disc.path,
+            compressed_size,
+            100 * ratio,
+        )
+
+        with db.Session() as session:
+            disc.send_path = compression.output
+            disc.size = compressed_size
+            disc.status = db.DiscStatus.SENDABLE
+            session.merge(disc)
+            session.commit()
+
+        self.space.release(compression.output)
+        self.space.unlink(disc.path)
+        self.on_compressed.dispatch()
+
+    def _finalize_failure(self, compression: Compression, returncode: int):
+        disc = compression.disc
+        log.warn(
+            "Compression of %s failed with status %d, sending as is",
+            disc.path,
+            returncode,
+        )
+        isopod.os.force_unlink(compression.output)
+        self.space.release(compression.output)
+        self._mark_sendable(disc)
+
+    def _mark_sendable(self, disc: db.Disc):
+        with db.Session() as session:
+            disc.status = db.DiscStatus.SENDABLE
+            session.merge(disc)
+            session.commit()
+        self.on_compressed.dispatch()
+
+    def _get_next_disc(self) -> Optional[db.Disc]:
+        with db.Session() as session:
+            stmt = (
+                select(db.Disc)
+                .filter_by(status=db.DiscStatus.COMPRESSIBLE)
+                .order_by(db.Disc.ripped_at.asc().nulls_last(), db.Disc.path.asc())
+                .limit(1)
+            )
+            return session.execute(stmt).scalar_one_or_none()
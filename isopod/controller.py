@@ -1,7 +1,14 @@
+import asyncio
+import logging
+import os
+import time
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from threading import Event, Thread, Timer
-from typing import Callable
+from subprocess import TimeoutExpired
+from threading import Event, Lock, Thread
+from typing import Callable, Optional, Protocol
+
+from isopod.scheduler import Scheduler, Wakeup
 
 
 class Result(ABC):
@@ -26,22 +33,111 @@ class RepollAfter(Result):
     seconds: float
 
 
+class Process(Protocol):
+    """
+    Work running in the background, with the subset of the
+    :class:`subprocess.Popen` interface that controllers rely on.
+    """
+
+    def poll(self) -> Optional[int]: ...
+
+    def wait(self, timeout: Optional[float] = None) -> int: ...
+
+    def terminate(self): ...
+
+
+class ThreadJob(ABC):
+    """
+    A :class:`Process` that works in a background thread of this process.
+    Subclasses call :meth:`_start` once they're set up, and implement
+    :meth:`_work`, which returns the exit status and should return early once
+    ``_stop`` is set. Any of ``errors`` ends the job with status 1, or -15 if
+    it was terminated.
+
+    :param description: What the job does, for logs and timeouts
+    """
+
+    errors: tuple[type[Exception], ...] = (OSError,)
+
+    def __init__(self, description: str):
+        self.description = description
+        self.returncode: Optional[int] = None
+        self._stop = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+
+    def poll(self) -> Optional[int]:
+        return self.returncode
+
+    def wait(self, timeout: Optional[float] = None) -> int:
+        self._thread.join(timeout)
+        if self.returncode is None:
+            raise TimeoutExpired(self.description, timeout or 0)
+        return self.returncode
+
+    def terminate(self):
+        self._stop.set()
+
+    def _start(self):
+        self._thread.start()
+
+    @abstractmethod
+    def _work(self) -> int:
+        pass
+
+    def _run(self):
+        try:
+            self.returncode = self._work()
+        except self.errors as e:
+            if not self._stop.is_set():
+                log = logging.getLogger(type(self).__module__)
+                log.error("%s failed: %s", self.description, e)
+            self.returncode = -15 if self._stop.is_set() else 1
+
+
+@dataclass
+class ReconcileTrace:
+    """
+    Timing of a single call to a controller's reconciler, as passed to hooks
+    registered with :func:`add_trace_hook`. Times come from
+    :func:`time.monotonic`.
+
+    :param controller: The controller that reconciled
+    :param polled: When the earliest poll served by this reconcile was made
+    :param started: When the reconciler was called
+    :param finished: When the reconciler returned
+    :param polls: The number of polls coalesced into this reconcile
+    :param result: The reconciler's result, or None if it raised
+    """
+
+    controller: "Controller"
+    polled: float
+    started: float
+    finished: float
+    polls: int
+    result: Optional[Result]
+
+    @property
+    def name(self) -> str:
+        return type(self.controller).__name__
+
+    @property
+    def latency(self) -> float:
+        return self.started - self.polled
+
+    @property
+    def duration(self) -> float:
+        return self.finished - self.started
+
+
 class Controller(ABC):
     """
     A representation of logic that incrementally drives the actual state of the
     world toward a desired state upon request.
     """
 
-    # TODO: My first-pass implementation of controllers calls subclass methods
-    # in a per-instance background thread. There are probably better approaches,
-    # but I have no concrete need to explore them right now.
-
     def __init__(self):
-        self._trigger = Event()
         self._canceled = False
-        self._repoller = None
-        self._thread = Thread(target=self._run, daemon=False)
-        self._thread.start()
+        self._runner = _runtime.start(self)
 
     @abstractmethod
     def reconcile(self) -> Result:
@@ -50,7 +146,7 @@ class Controller(ABC):
         converge it with some desired state of the world. To be implemented by
         subclasses and invoked by the controller.
 
-        A :class:`Controller` invokes `reconcile` in a separate thread shortly
+        A :class:`Controller` invokes `reconcile` in the background shortly
         after one or more calls to :meth:`poll`, never making more than one
         concurrent call to the same reconciler. Reconcilers should return
         quickly, and manage threads or subprocesses for long-running work. To
@@ -72,12 +168,16 @@ class Controller(ABC):
 
     def poll(self):
         """Schedule a call to the reconciler in the background shortly in the future."""
-        self._trigger.set()
+        self._runner.poll()
+
+    def poll_on_exit(self, proc: Process):
+        """Schedule a call to the reconciler after a process exits."""
+        self._runner.poll_on_exit(proc)
 
     def cancel(self):
         """Request that the controller cancel any pending work."""
         self._canceled = True
-        self._trigger.set()
+        self._runner.poll()
 
     @property
     def canceled(self):
@@ -85,8 +185,75 @@ class Controller(ABC):
 
     def join(self):
         """Wait for the controller to finish pending work after cancellation."""
+        self._runner.join()
+
+
+class Runner(ABC):
+    """Calls into a single controller on behalf of a :class:`Runtime`."""
+
+    @abstractmethod
+    def poll(self):
+        pass
+
+    @abstractmethod
+    def poll_on_exit(self, proc: Process):
+        pass
+
+    @abstractmethod
+    def join(self):
+        pass
+
+
+class Runtime(ABC):
+    """Decides where and when controllers call their reconcilers."""
+
+    @abstractmethod
+    def start(self, controller: Controller) -> Runner:
+        pass
+
+
+class ThreadRuntime(Runtime):
+    """
+    Runs each controller in its own thread, with a waiter thread for each
+    process. Every controller shares one :class:`Scheduler` thread for
+    :class:`RepollAfter` wakeups.
+    """
+
+    def __init__(self, scheduler: Optional[Scheduler] = None):
+        self.scheduler = scheduler or Scheduler()
+
+    def start(self, controller: Controller) -> Runner:
+        return _ThreadRunner(controller, self.scheduler)
+
+
+class _ThreadRunner(Runner):
+    # TODO: My first-pass implementation of controllers calls subclass methods
+    # in a per-instance background thread. There are probably better approaches,
+    # but I have no concrete need to explore them right now.
+
+    def __init__(self, controller: Controller, scheduler: Scheduler):
+        self._controller = controller
+        self._scheduler = scheduler
+        self._trigger = Event()
+        self._polls = _PollCounter()
+        self._repoller: Optional[Wakeup] = None
+        self._thread = Thread(target=self._run, daemon=False)
+        self._thread.start()
+
+    def poll(self):
+        self._polls.add()
+        self._trigger.set()
+
+    def poll_on_exit(self, proc: Process):
+        Thread(target=self._poll_after_exit, args=(proc,), daemon=True).start()
+
+    def join(self):
         self._thread.join()
 
+    def _poll_after_exit(self, proc: Process):
+        proc.wait()
+        self.poll()
+
     def _run(self):
         # TODO: The Isopod daemon installs a global hook to exit the process on
         # unhandled exceptions in threads; otherwise, Python merely logs the
@@ -94,22 +261,195 @@ class Controller(ABC):
         # abstraction wouldn't rely on a global hook to avoid silent breakage.
         while self._trigger.wait():
             if self._repoller is not None:
-                self._repoller.cancel()
-                self._repoller.join()
+                self._scheduler.cancel(self._repoller)
                 self._repoller = None
 
             self._trigger.clear()
 
-            if self._canceled:
-                self.cleanup()
+            if self._controller.canceled:
+                self._controller.cleanup()
                 return
 
-            match self.reconcile():
+            match _traced_reconcile(self._controller, self._polls):
                 case Reconciled():
                     pass
                 case RepollAfter(seconds=seconds):
-                    self._repoller = Timer(seconds, self.poll)
-                    self._repoller.start()
+                    self._repoller = self._scheduler.call_later(seconds, self.poll)
+
+
+class AsyncioRuntime(Runtime):
+    """
+    Runs every controller on a single asyncio event loop in one thread. Repolls
+    are loop timers, and process exits are watched through pidfds, so neither
+    needs a thread of its own.
+
+    Cleanup still runs in a separate thread, since it can block for as long as
+    in-flight work takes to finish.
+    """
+
+    def __init__(self):
+        self._loop = asyncio.new_event_loop()
+        self._loop.set_exception_handler(self._handle_exception)
+        self._thread = None
+        self._lock = Lock()
+
+    def start(self, controller: Controller) -> Runner:
+        with self._lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return _AsyncioRunner(controller, self._loop)
+
+    def _run(self):
+        self._loop.run_forever()
+        # The loop only stops on an unhandled exception in a controller. Let
+        # it escape the thread like it would from a thread runtime controller.
+        raise RuntimeError("Controller event loop stopped unexpectedly")
+
+    @staticmethod
+    def _handle_exception(loop: asyncio.AbstractEventLoop, context: dict):
+        loop.default_exception_handler(context)
+        loop.stop()
+
+
+class _AsyncioRunner(Runner):
+    def __init__(self, controller: Controller, loop: asyncio.AbstractEventLoop):
+        self._controller = controller
+        self._loop = loop
+        self._scheduled = False
+        self._stopping = False
+        self._polls = _PollCounter()
+        self._repoller: Optional[asyncio.TimerHandle] = None
+        self._done = Event()
+
+    def poll(self):
+        self._polls.add()
+        self._loop.call_soon_threadsafe(self._schedule)
+
+    def poll_on_exit(self, proc: Process):
+        if (pid := getattr(proc, "pid", None)) is None:
+            Thread(target=self._poll_after_exit, args=(proc,), daemon=True).start()
+            return
+
+        try:
+            pidfd = os.pidfd_open(pid)
+        except ProcessLookupError:
+            self.poll()
+            return
+
+        def on_exit():
+            self._loop.remove_reader(pidfd)
+            os.close(pidfd)
+            self._polls.add()
+            self._schedule()
+
+        self._loop.call_soon_threadsafe(self._loop.add_reader, pidfd, on_exit)
+
+    def join(self):
+        self._done.wait()
+
+    def _poll_after_exit(self, proc: Process):
+        proc.wait()
+        self.poll()
+
+    def _schedule(self):
+        # Coalesce any number of polls into a single reconcile.
+        if not self._scheduled and not self._stopping:
+            self._scheduled = True
+            self._loop.call_soon(self._reconcile)
+
+    def _reconcile(self):
+        self._scheduled = False
+        if self._repoller is not None:
+            self._repoller.cancel()
+            self._repoller = None
+
+        if self._controller.canceled:
+            self._stopping = True
+            Thread(target=self._cleanup, daemon=False).start()
+            return
+
+        match _traced_reconcile(self._controller, self._polls):
+            case Reconciled():
+                pass
+            case RepollAfter(seconds=seconds):
+                self._repoller = self._loop.call_later(seconds, self._repoll)
+
+    def _repoll(self):
+        self._polls.add()
+        self._schedule()
+
+    def _cleanup(self):
+        try:
+            self._controller.cleanup()
+        finally:
+            self._done.set()
+
+
+class _PollCounter:
+    """Tracks the polls that a runner has received since its last reconcile."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._first: Optional[float] = None
+        self._count = 0
+
+    def add(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._first is None:
+                self._first = now
+            self._count += 1
+
+    def take(self) -> tuple[float, int]:
+        """Return the time of the first poll and the count, and reset both."""
+        now = time.monotonic()
+        with self._lock:
+            first, count = self._first, self._count
+            self._first, self._count = None, 0
+        return (first if first is not None else now), count
+
+
+def _traced_reconcile(controller: Controller, polls: _PollCounter) -> Result:
+    polled, count = polls.take()
+    if not _trace_hooks:
+        return controller.reconcile()
+
+    started = time.monotonic()
+    result = None
+    try:
+        result = controller.reconcile()
+        return result
+    finally:
+        trace = ReconcileTrace(
+            controller=controller,
+            polled=polled,
+            started=started,
+            finished=time.monotonic(),
+            polls=count,
+            result=result,
+        )
+        for hook in _trace_hooks:
+            hook(trace)
+
+
+_runtime: Runtime = ThreadRuntime()
+_trace_hooks: list[Callable[[ReconcileTrace], None]] = []
+
+
+def use_runtime(runtime: Runtime):
+    """Set the runtime for every controller created after this call."""
+    global _runtime
+    _runtime = runtime
+
+
+def add_trace_hook(hook: Callable[[ReconcileTrace], None]):
+    """
+    Call ``hook`` with a :class:`ReconcileTrace` after every reconcile of every
+    controller. Hooks run on the thread that called the reconciler, and should
+    return quickly.
+    """
+    _trace_hooks.append(hook)
 
 
 class EventSet:
@@ -9,15 +9,28 @@ import shutil
 import signal
 import sys
 import threading
+from datetime import datetime
+from typing import Optional
 
 import click
-from sqlalchemy import create_engine, select
+from sqlalchemy import select
 
+import isopod.bandwidth
+import isopod.checksum
+import isopod.chunking
+import isopod.compressor
+import isopod.controller
+import isopod.ddrescue
+import isopod.engine
 import isopod.linux
+import isopod.metrics
 import isopod.os
 import isopod.reporter
 import isopod.ripper
 import isopod.sender
+import isopod.space
+import isopod.tracing
+import isopod.transport
 from isopod import db
 
 
@@ -47,9 +60,10 @@ context_settings = {"help_option_names": ["-h", "--help"]}
 )
 @click.option(
     "--device",
+    "devices",
     type=click.Path(exists=True, readable=True),
-    default="/dev/cdrom",
-    help="The CD-ROM drive to rip from",
+    multiple=True,
+    help="A CD-ROM drive to rip from (repeatable; default: all drives)",
 )
 @click.option(
     "--target", type=str, required=True, help="The base rsync target to receive ISOs"
@@ -60,60 +74,368 @@ context_settings = {"help_option_names": ["-h", "--help"]}
     default=5 * (1024**3),
     help="Only rip when this much space will be free after",
 )
+@click.option(
+    "--send-concurrency",
+    type=click.IntRange(min=1),
+    default=1,
+    help="The number of ISOs to send at the same time",
+)
+@click.option(
+    "--send-order",
+    type=click.Choice(["fifo", "smallest", "round-robin", "penalized"]),
+    default="fifo",
+    help="The order to send ISOs in: by rip time, smallest first, taking turns "
+    "between drives, or putting discs that failed to send last",
+)
+@click.option(
+    "--pipeline-sends",
+    is_flag=True,
+    default=False,
+    help="Start sending ISOs while they are still being ripped",
+)
+@click.option(
+    "--batch-max-discs",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Send up to this many ISOs in each rsync session",
+)
+@click.option(
+    "--batch-max-bytes",
+    type=click.IntRange(min=1),
+    default=isopod.sender.BATCH_MAX_BYTES,
+    help="Stop adding ISOs to an rsync session at this many bytes",
+)
+@click.option(
+    "--chunked-sends",
+    is_flag=True,
+    default=False,
+    help="Send ISOs as content-defined chunks, skipping chunks already sent",
+)
+@click.option(
+    "--transport",
+    type=click.Choice(["rsync", "stream"]),
+    default="rsync",
+    help="How to send ISOs: with rsync, or streamed to an isopod receiver at"
+    " HOST[:PORT] given as the target",
+)
+@click.option(
+    "--ssh-multiplex/--no-ssh-multiplex",
+    default=True,
+    help="Share one SSH connection between all sends to an SSH target",
+)
+@click.option(
+    "--verify-remote-sha256",
+    is_flag=True,
+    default=False,
+    help="Check each ISO's SHA-256 on SSH targets after sending",
+)
+@click.option(
+    "--bwlimit",
+    type=click.IntRange(min=1),
+    default=None,
+    metavar="KIBPS",
+    help="Cap the total rate of sends, in KiB per second",
+)
+@click.option(
+    "--bwlimit-capacity-fraction",
+    type=click.FloatRange(min=0, max=1, min_open=True),
+    default=None,
+    help="Cap sends at this fraction of the measured uplink throughput",
+)
+@click.option(
+    "--full-speed-window",
+    "full_speed_windows",
+    multiple=True,
+    callback=lambda ctx, param, value: _parse_windows(value),
+    metavar="HH:MM-HH:MM",
+    help="Send without rate limits at these times of day (repeatable)",
+)
+@click.option(
+    "--compress",
+    is_flag=True,
+    default=False,
+    help="Compress ISOs with zstd while they wait to be sent",
+)
+@click.option(
+    "--compress-level",
+    type=click.IntRange(min=1, max=19),
+    default=3,
+    help="The zstd compression level",
+)
+@click.option(
+    "--compress-threads",
+    type=click.IntRange(min=0),
+    default=0,
+    help="The number of zstd worker threads (0: one per CPU core)",
+)
+@click.option(
+    "--sparse",
+    is_flag=True,
+    default=False,
+    help="Skip sectors that the disc's ISO 9660 file system doesn't use, "
+    "storing and sending them as zeros in sparse files",
+)
+@click.option(
+    "--resume-rips",
+    is_flag=True,
+    default=False,
+    help="Keep incomplete rips to resume if the same disc is inserted again",
+)
+@click.option(
+    "--duplicates",
+    type=click.Choice(["rip", "flag", "skip"]),
+    default="rip",
+    help="What to do with discs whose content was already ripped",
+)
+@click.option(
+    "--rip-engine",
+    type=click.Choice(["ddrescue", "native"]),
+    default="ddrescue",
+    help="How to read discs: with GNU ddrescue, or with Isopod's own reader",
+)
+@click.option(
+    "--runtime",
+    type=click.Choice(["threads", "asyncio"]),
+    default="threads",
+    help="Run controllers in their own threads, or together on an event loop",
+)
+@click.option(
+    "--metrics-address",
+    type=str,
+    default=None,
+    metavar="HOST:PORT",
+    help="Serve Prometheus metrics at this address",
+)
+@click.option(
+    "--trace-summary-interval",
+    type=click.FloatRange(min=0, min_open=True),
+    default=None,
+    metavar="SECONDS",
+    help="Log a summary of controller reconcile timings at this interval",
+)
+@click.option(
+    "--trace-file",
+    type=click.Path(dir_okay=False, writable=True),
+    default=None,
+    help="Write controller reconcile timings to this Chrome trace file",
+)
 @click.option(
     "--journal-ddrescue-output",
     is_flag=True,
     default=False,
     help='Write ddrescue output to the "isopod-ripper" journal namespace',
 )
-def main(workdir, logdir, device, target, min_free_bytes, journal_ddrescue_output):
-    """Watch a CD-ROM drive and rip every disc to a remote server."""
+def main(
+    workdir,
+    logdir,
+    devices,
+    target,
+    min_free_bytes,
+    send_concurrency,
+    send_order,
+    pipeline_sends,
+    batch_max_discs,
+    batch_max_bytes,
+    chunked_sends,
+    transport,
+    ssh_multiplex,
+    verify_remote_sha256,
+    bwlimit,
+    bwlimit_capacity_fraction,
+    full_speed_windows,
+    compress,
+    compress_level,
+    compress_threads,
+    sparse,
+    resume_rips,
+    duplicates,
+    rip_engine,
+    runtime,
+    metrics_address,
+    trace_summary_interval,
+    trace_file,
+    journal_ddrescue_output,
+):
+    """Watch CD-ROM drives and rip every disc to a remote server."""
+
+    engine: isopod.engine.RipEngine
+    if rip_engine == "native":
+        engine = isopod.engine.NativeEngine()
+    else:
+        engine = isopod.engine.DdrescueEngine(journal_output=journal_ddrescue_output)
+
+    if compress and pipeline_sends:
+        log.critical("--compress and --pipeline-sends can't be used together")
+        log.critical("Early sends need the ISO itself, not a compressed copy")
+        sys.exit(1)
+
+    if chunked_sends and (pipeline_sends or compress):
+        log.critical(
+            "--chunked-sends can't be used with --pipeline-sends or --compress"
+        )
+        log.critical("Chunks must be cut from the finished, uncompressed ISO")
+        sys.exit(1)
+    if chunked_sends and batch_max_discs > 1:
+        log.critical("--chunked-sends can't be used with --batch-max-discs")
+        sys.exit(1)
+    if chunked_sends and verify_remote_sha256:
+        log.warn("Remote SHA-256 checks are skipped for chunked sends")
+
+    send_transport: Optional[isopod.transport.Transport] = None
+    if transport == "stream":
+        if pipeline_sends or chunked_sends or batch_max_discs > 1:
+            log.critical("--transport=stream only sends whole ISOs one at a time")
+            log.critical(
+                "It can't be used with --pipeline-sends, --chunked-sends,"
+                " or --batch-max-discs"
+            )
+            sys.exit(1)
+        if verify_remote_sha256:
+            log.warn("The stream receiver checks each ISO's SHA-256 itself")
+        send_transport = isopod.transport.StreamTransport(
+            isopod.transport.parse_address(target)
+        )
 
-    required_cmds = ("ddrescue", "rsync")
+    required_cmds = engine.required_cmds
+    if send_transport is not None:
+        required_cmds += send_transport.required_cmds
+    else:
+        required_cmds += ("rsync",)
+    if compress:
+        required_cmds += ("zstd",)
     missing_cmds = [cmd for cmd in required_cmds if shutil.which(cmd) is None]
     if missing_cmds:
         log.critical("Missing required commands: %s", missing_cmds)
         log.critical("Isopod needs these installed to rip and send discs")
         sys.exit(1)
 
-    diskseq = isopod.linux.get_diskseq(device)
-    if diskseq is None or int(diskseq) == 0:
-        log.critical("%s does not have a valid diskseq in udev", device)
-        log.critical("Isopod will behave erratically in this configuration")
-        log.critical("Try a newer Linux kernel (5.15+) and/or udev")
+    devices = get_rip_devices(devices)
+    if not devices:
+        log.critical("No CD-ROM drives found")
         sys.exit(1)
 
+    for device in devices:
+        diskseq = isopod.linux.get_diskseq(device)
+        if diskseq is None or int(diskseq) == 0:
+            log.critical("%s does not have a valid diskseq in udev", device)
+            log.critical("Isopod will behave erratically in this configuration")
+            log.critical("Try a newer Linux kernel (5.15+) and/or udev")
+            sys.exit(1)
+
+    if trace_file is not None:
+        trace_file = os.path.abspath(trace_file)
     workdir = os.path.abspath(workdir)
     log.info("Entering workdir: %s", workdir)
     os.chdir(workdir)
 
     isopod.linux.init_fresh_boot()
-    db.setup(create_engine(f"sqlite+pysqlite:///isopod.sqlite3"))
-    remove_stale_disc_files()
-
-    ripper = isopod.ripper.Ripper(
-        device_path=device,
-        min_free_bytes=min_free_bytes,
-        event_log_dir=logdir,
-        journal_ddrescue_output=journal_ddrescue_output,
+    db.setup(db.sqlite_engine("isopod.sqlite3"))
+    remove_stale_disc_files(resume_rips, compress)
+
+    if metrics_address is not None:
+        host, _, port = metrics_address.rpartition(":")
+        if not host or not port.isdigit():
+            log.critical("Invalid metrics address: %s", metrics_address)
+            sys.exit(1)
+        isopod.metrics.REGISTRY.add_collector(collect_disc_metrics)
+        isopod.controller.add_trace_hook(isopod.metrics.observe_reconcile)
+        isopod.metrics.serve(host.strip("[]"), int(port))
+
+    if trace_summary_interval is not None:
+        isopod.controller.add_trace_hook(
+            isopod.tracing.SummaryLogger(trace_summary_interval)
+        )
+    trace_writer = None
+    if trace_file is not None:
+        trace_writer = isopod.tracing.ChromeTraceWriter(trace_file)
+        isopod.controller.add_trace_hook(trace_writer)
+
+    if runtime == "asyncio":
+        isopod.controller.use_runtime(isopod.controller.AsyncioRuntime())
+    else:
+        thread_runtime = isopod.controller.ThreadRuntime()
+        isopod.controller.use_runtime(thread_runtime)
+        if metrics_address is not None:
+            isopod.metrics.watch_scheduler(thread_runtime.scheduler)
+
+    space = isopod.space.SpaceLedger()
+    rippers = []
+    for device in devices:
+        log.info("Watching drive: %s", device)
+        rippers.append(
+            isopod.ripper.Ripper(
+                device_path=device,
+                min_free_bytes=min_free_bytes,
+                event_log_dir=logdir,
+                engine=engine,
+                space=space,
+                resume=resume_rips,
+                duplicates=isopod.ripper.DuplicatePolicy[duplicates.upper()],
+                compress=compress,
+                sparse=sparse,
+            )
+        )
+
+    bandwidth = None
+    if bwlimit is not None or bwlimit_capacity_fraction is not None:
+        bandwidth = isopod.bandwidth.BandwidthPolicy(
+            limit=bwlimit,
+            windows=full_speed_windows,
+            capacity_fraction=bwlimit_capacity_fraction,
+        )
+    elif full_speed_windows:
+        log.warn("Full speed windows have no effect without a rate limit")
+
+    sender = isopod.sender.Sender(
+        target,
+        concurrency=send_concurrency,
+        pipeline=pipeline_sends,
+        verify_remote=verify_remote_sha256,
+        space=space,
+        bandwidth=bandwidth,
+        queue_policy=isopod.sender.QueuePolicy[send_order.upper().replace("-", "_")],
+        sparse=sparse,
+        chunked=chunked_sends,
+        batch_max_discs=batch_max_discs,
+        batch_max_bytes=batch_max_bytes,
+        multiplex=ssh_multiplex,
+        transport=send_transport,
     )
-    sender = isopod.sender.Sender(target)
-    reporter = isopod.reporter.Reporter(ripper)
+    compressor = None
+    if compress:
+        compressor = isopod.compressor.Compressor(
+            space, level=compress_level, threads=compress_threads
+        )
+        compressor.on_compressed.add(sender.poll)
+        db.DISCS.on_change.add(compressor.poll)
+
+    reporter = isopod.reporter.Reporter(rippers[0])
     if isinstance(reporter, isopod.reporter.NullReporter):
         isopod.reporter.log.info("No E-Ink display support, skipping status updates")
     else:
         isopod.reporter.log.info("Reporting status to E-Ink display")
+        if len(rippers) > 1:
+            isopod.reporter.log.info("Display follows %s only", devices[0])
 
-    ripper.on_status_change.add(sender.poll)
-    ripper.on_status_change.add(reporter.poll)
-    sender.on_send_success.add(reporter.poll)
+    # Rips become ready to compress or send when their disc changes state, which
+    # can be a while after the ripper itself has moved on.
+    db.DISCS.on_change.add(sender.poll)
+    rippers[0].on_status_change.add(reporter.poll)
+    db.DISCS.on_change.add(reporter.poll)
 
     wait_for_any_signal_once(signal.SIGINT, signal.SIGTERM)
     log.info("Received stop signal")
 
-    log.info("Shutting down ripper")
-    ripper.cancel()
-    ripper.join()
+    log.info("Shutting down rippers")
+    for ripper in rippers:
+        ripper.cancel()
+    for ripper in rippers:
+        ripper.join()
+
+    if compressor is not None:
+        log.info("Shutting down compressor")
+        compressor.cancel()
+        compressor.join()
 
     log.info("Shutting down reporter and sender")
     reporter.cancel()
@@ -121,25 +443,123 @@ def main(workdir, logdir, device, target, min_free_bytes, journal_ddrescue_outpu
     reporter.join()
     sender.join()
 
+    if trace_writer is not None:
+        trace_writer.close()
+
+
+def _parse_windows(specs: tuple[str, ...]) -> list[isopod.bandwidth.Window]:
+    try:
+        return [isopod.bandwidth.Window.parse(spec) for spec in specs]
+    except ValueError as e:
+        raise click.BadParameter(str(e))
 
-def remove_stale_disc_files():
+
+def get_rip_devices(devices: tuple[str, ...]) -> list[str]:
+    if not devices:
+        devices = tuple(
+            dev.device_node
+            for dev in isopod.linux.get_cdrom_drives()
+            if dev.device_node is not None
+        )
+
+    # The same drive can be reachable through more than one path (e.g.
+    # /dev/cdrom and /dev/sr0), and two rippers must never share a drive.
+    unique = {}
+    for device in devices:
+        unique.setdefault(os.path.realpath(device), device)
+    return list(unique.values())
+
+
+def remove_stale_disc_files(resume_rips: bool, compress: bool):
     with db.Session() as session:
-        stmt = select(db.Disc).filter_by(status=db.DiscStatus.RIPPABLE)
+        stmt = select(db.Disc).where(
+            db.Disc.status.in_((db.DiscStatus.RIPPABLE, db.DiscStatus.RESUMABLE))
+        )
         for disc in session.execute(stmt).scalars():
+            if resume_rips and _is_resumable(disc):
+                if disc.status != db.DiscStatus.RESUMABLE:
+                    disc.status = db.DiscStatus.RESUMABLE
+                    session.commit()
+                    log.info("Saved incomplete rip %s to resume later", disc.path)
+                continue
+
             isopod.os.force_unlink(disc.path)
+            if disc.mapfile:
+                isopod.os.force_unlink(disc.mapfile)
+            isopod.os.force_unlink(isopod.ddrescue.domain_path(disc.path))
             session.delete(disc)
             session.commit()
             log.info("Cleaned up incomplete rip %s", disc.path)
 
-        lingering_isos = [path for path in os.listdir() if path.endswith(".iso")]
+        stmt = select(db.Disc).filter_by(status=db.DiscStatus.COMPRESSIBLE)
+        for disc in session.execute(stmt).scalars():
+            # The compressor starts over from the ISO, or the ISO is sent as is.
+            output = isopod.compressor.compressed_path(disc.path)
+            isopod.os.force_unlink(output)
+            if not compress:
+                disc.status = db.DiscStatus.SENDABLE
+                session.commit()
+                log.info("Will send %s without compressing", disc.path)
+
+        for path in os.listdir():
+            if path.endswith(".iso.chunks"):
+                isopod.chunking.remove_staging(path)
+                log.info("Cleaned up chunk staging directory %s", path)
+            elif path.startswith("batch-") and path.endswith((".files", ".log")):
+                isopod.os.force_unlink(path)
+
+        lingering_files = [
+            path for path in os.listdir() if path.endswith((".iso", ".iso.zst"))
+        ]
         stmt = (
             select(db.Disc)
-            .where(db.Disc.path.in_(lingering_isos))
+            .where(
+                db.Disc.path.in_(lingering_files)
+                | db.Disc.send_path.in_(lingering_files)
+            )
             .filter_by(status=db.DiscStatus.COMPLETE)
         )
         for disc in session.execute(stmt).scalars():
             isopod.os.force_unlink(disc.path)
-            log.info("Cleaned up sent disc %s", disc.path)
+            isopod.os.force_unlink(disc.staged_path)
+            isopod.os.force_unlink(isopod.checksum.sidecar_path(disc.path))
+            log.info("Cleaned up sent disc %s", disc.staged_path)
+
+
+def collect_disc_metrics():
+    for status, count in db.DISCS.counts().items():
+        isopod.metrics.DISCS.set(count, status=status.name)
+
+    with db.Session() as session:
+        isopod.metrics.SEND_ERRORS.clear()
+        isopod.metrics.SEND_BACKOFF_SECONDS.clear()
+        isopod.metrics.SEND_SENT_BYTES.clear()
+        isopod.metrics.SEND_RATE_BYTES_PER_SECOND.clear()
+        isopod.metrics.SEND_ETA_SECONDS.clear()
+        now = datetime.utcnow()
+        stmt = select(db.Disc).filter_by(status=db.DiscStatus.SENDABLE)
+        for disc in session.execute(stmt).scalars():
+            isopod.metrics.SEND_ERRORS.set(disc.send_errors, disc=disc.path)
+            backoff = (disc.next_send_attempt - now).total_seconds()
+            isopod.metrics.SEND_BACKOFF_SECONDS.set(max(0, backoff), disc=disc.path)
+            if disc.sent_bytes is not None:
+                isopod.metrics.SEND_SENT_BYTES.set(disc.sent_bytes, disc=disc.path)
+            if disc.send_rate is not None:
+                isopod.metrics.SEND_RATE_BYTES_PER_SECOND.set(
+                    disc.send_rate, disc=disc.path
+                )
+            if disc.send_eta is not None:
+                eta = (disc.send_eta - now).total_seconds()
+                isopod.metrics.SEND_ETA_SECONDS.set(max(0, eta), disc=disc.path)
+
+
+def _is_resumable(disc: db.Disc) -> bool:
+    return (
+        disc.fingerprint is not None
+        and disc.mapfile is not None
+        and os.path.exists(disc.mapfile)
+        and os.path.exists(disc.path)
+    )
 
 
 def wait_for_any_signal_once(*args):
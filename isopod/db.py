@@ -1,40 +1,383 @@
 import datetime
 import logging
+from collections import defaultdict
+from dataclasses import dataclass
 from enum import Enum, auto
-from typing import Optional
+from itertools import chain
+from threading import Lock
+from typing import Iterable, Optional
 
-from sqlalchemy import Engine, func
+from sqlalchemy import (
+    Connection,
+    Engine,
+    Table,
+    create_engine,
+    event,
+    func,
+    inspect,
+    select,
+)
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, sessionmaker
+from sqlalchemy.pool import QueuePool
+
+from isopod.controller import EventSet
 
 log = logging.getLogger(__name__)
 
 Session = sessionmaker()
 
+# Every controller thread, and a few helper threads, hold a connection for
+# about as long as a query takes. Keep enough open that they rarely wait on
+# the pool, and never hold the database for long enough to need more.
+POOL_SIZE = 8
+POOL_MAX_OVERFLOW = 8
+
+# In WAL mode, readers in other threads carry on while one thread commits,
+# and with synchronous=NORMAL a commit only waits on fsync at checkpoints
+# instead of twice per commit, which adds up on SD cards. A writer that does
+# find the database locked waits for up to BUSY_TIMEOUT_SEC.
+BUSY_TIMEOUT_SEC = 30
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA busy_timeout={BUSY_TIMEOUT_SEC * 1000}",
+)
+
 
 class Base(DeclarativeBase):
     pass
 
 
+def sqlite_engine(path: str) -> Engine:
+    """Create an engine for the SQLite database at ``path``, tuned for Isopod."""
+    engine = create_engine(
+        f"sqlite+pysqlite:///{path}",
+        poolclass=QueuePool,
+        pool_size=POOL_SIZE,
+        max_overflow=POOL_MAX_OVERFLOW,
+        connect_args={"timeout": BUSY_TIMEOUT_SEC, "check_same_thread": False},
+    )
+    event.listen(engine, "connect", _configure_sqlite)
+    return engine
+
+
+def _configure_sqlite(dbapi_connection, _):
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(pragma)
+    finally:
+        cursor.close()
+
+
 def setup(engine: Engine):
     """Initialize the database schema and configure SQLAlchemy sessions to use it."""
     log.info("Configuring database: %s", engine)
     Session.configure(bind=engine)
-    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        _migrate(conn)
+    DISCS.load()
+
+
+def _migrate(conn: Connection):
+    """
+    Bring the schema up to date. Each entry of :data:`MIGRATIONS` changes the
+    tables of an existing database from the schema version at its index to the
+    next, where version 0 is the original ``discs`` table. New tables and
+    indexes are created afterward, so migrations only have to change tables
+    that already exist. The version lives in SQLite's ``user_version``.
+
+    Migrations only add what's missing, and every index is checked for on
+    each start, so a database from any earlier version of Isopod comes up to
+    date, including ones that other versions created at schema version 0.
+    """
+
+    version = conn.exec_driver_sql("PRAGMA user_version").scalar_one()
+    if not inspect(conn).has_table(Disc.__tablename__):
+        version = len(MIGRATIONS)
+    elif version > len(MIGRATIONS):
+        raise RuntimeError(f"Database schema version {version} is too new")
+
+    for i in range(version, len(MIGRATIONS)):
+        log.info("Migrating database to schema version %d", i + 1)
+        MIGRATIONS[i](conn)
+
+    Base.metadata.create_all(conn)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+    conn.exec_driver_sql(f"PRAGMA user_version = {len(MIGRATIONS)}")
 
 
 class DiscStatus(Enum):
     RIPPABLE = auto()
     SENDABLE = auto()
     COMPLETE = auto()
+    RESUMABLE = auto()
+    COMPRESSIBLE = auto()
 
 
 class Disc(Base):
     __tablename__ = "discs"
 
     path: Mapped[str] = mapped_column(primary_key=True)
-    status: Mapped[DiscStatus] = mapped_column(default=DiscStatus.RIPPABLE)
-    source_hash: Mapped[Optional[bytes]]
+    status: Mapped[DiscStatus] = mapped_column(default=DiscStatus.RIPPABLE, index=True)
+    source_hash: Mapped[Optional[bytes]] = mapped_column(index=True)
+    fingerprint: Mapped[Optional[bytes]] = mapped_column(index=True)
+    duplicate_of: Mapped[Optional[str]]
+    mapfile: Mapped[Optional[str]]
+    sha256: Mapped[Optional[str]]
+    send_path: Mapped[Optional[str]]
+    drive: Mapped[Optional[str]] = mapped_column(index=True)
+    drive_id: Mapped[Optional[str]] = mapped_column(index=True)
+    size: Mapped[Optional[int]] = mapped_column(index=True)
+    rip_started_at: Mapped[Optional[datetime.datetime]]
+    ripped_at: Mapped[Optional[datetime.datetime]] = mapped_column(index=True)
+    rip_bytes: Mapped[Optional[int]]
+    bad_areas: Mapped[Optional[int]]
+    bad_bytes: Mapped[Optional[int]]
     send_errors: Mapped[int] = mapped_column(default=0)
+    send_offset: Mapped[int] = mapped_column(default=0)
+    sent_bytes: Mapped[Optional[int]]
+    send_rate: Mapped[Optional[float]]
+    send_eta: Mapped[Optional[datetime.datetime]]
     next_send_attempt: Mapped[datetime.datetime] = mapped_column(
-        server_default=func.now()
+        server_default=func.now(), index=True
     )
+
+    @property
+    def staged_path(self) -> str:
+        """The file in the workdir to send for this disc."""
+        return self.send_path or self.path
+
+
+class Chunk(Base):
+    """A piece of an ISO that has been sent to the target in chunked mode."""
+
+    __tablename__ = "chunks"
+
+    digest: Mapped[str] = mapped_column(primary_key=True)
+    size: Mapped[int]
+    first_disc: Mapped[Optional[str]]
+    sent_at: Mapped[datetime.datetime] = mapped_column(server_default=func.now())
+
+
+class SendAttempt(Base):
+    """One finished attempt to send a disc to the target, successful or not."""
+
+    __tablename__ = "send_attempts"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    disc: Mapped[str] = mapped_column(index=True)
+    started_at: Mapped[datetime.datetime] = mapped_column(index=True)
+    duration_sec: Mapped[float]
+    bytes: Mapped[Optional[int]]
+    result: Mapped[str]
+    concurrency: Mapped[int]
+    bwlimit: Mapped[Optional[int]]
+
+
+@dataclass(frozen=True)
+class DiscState:
+    """The parts of a disc that :class:`DiscIndex` keeps track of."""
+
+    status: DiscStatus
+    source_hash: Optional[bytes]
+    next_send_attempt: Optional[datetime.datetime]
+
+
+class DiscIndex:
+    """
+    An in-memory copy of every disc's status, source hash, and next send
+    attempt, so that controllers can check on the queue without querying the
+    database every time they reconcile.
+
+    :func:`setup` loads the index, and every ORM session commit that adds,
+    changes, or deletes discs updates it, then dispatches ``on_change``. Core
+    UPDATE statements bypass the ORM, so they must not change these columns.
+    """
+
+    def __init__(self):
+        self.on_change = EventSet()
+
+        self._lock = Lock()
+        self._states: dict[str, DiscState] = {}
+        self._by_status: defaultdict[DiscStatus, set[str]] = defaultdict(set)
+        self._by_source_hash: defaultdict[Optional[bytes], set[str]] = defaultdict(set)
+
+    def load(self):
+        with Session() as session:
+            stmt = select(
+                Disc.path, Disc.status, Disc.source_hash, Disc.next_send_attempt
+            )
+            states = {
+                path: DiscState(status, source_hash, next_send_attempt)
+                for path, status, source_hash, next_send_attempt in session.execute(
+                    stmt
+                )
+            }
+
+        with self._lock:
+            self._states.clear()
+            self._by_status.clear()
+            self._by_source_hash.clear()
+            for path, state in states.items():
+                self._insert(path, state)
+        log.info("Indexed %d disc(s)", len(states))
+
+    def get(self, path: str) -> Optional[DiscState]:
+        with self._lock:
+            return self._states.get(path)
+
+    def count(self, *statuses: DiscStatus) -> int:
+        with self._lock:
+            return sum(len(self._by_status[status]) for status in statuses)
+
+    def counts(self) -> dict[DiscStatus, int]:
+        with self._lock:
+            return {status: len(self._by_status[status]) for status in DiscStatus}
+
+    def has_source_hash(
+        self, source_hash: Optional[bytes], exclude: Iterable[DiscStatus] = ()
+    ) -> bool:
+        """Whether any disc with a status outside ``exclude`` has ``source_hash``."""
+        exclude = set(exclude)
+        with self._lock:
+            return any(
+                self._states[path].status not in exclude
+                for path in self._by_source_hash.get(source_hash, ())
+            )
+
+    def due(
+        self, status: DiscStatus, now: datetime.datetime
+    ) -> tuple[set[str], Optional[datetime.datetime]]:
+        """
+        Return the paths of discs with ``status`` whose next send attempt is
+        due by ``now``, and the earliest attempt among the rest (if any).
+        """
+
+        due, next_attempt = set(), None
+        with self._lock:
+            for path in self._by_status[status]:
+                attempt = self._states[path].next_send_attempt
+                if attempt is None or attempt <= now:
+                    due.add(path)
+                elif next_attempt is None or attempt < next_attempt:
+                    next_attempt = attempt
+        return due, next_attempt
+
+    def apply(self, changes: dict[str, Optional[DiscState]]):
+        """Update the index with new states, where ``None`` means deleted."""
+        with self._lock:
+            for path, state in changes.items():
+                self._remove(path)
+                if state is not None:
+                    self._insert(path, state)
+        self.on_change.dispatch()
+
+    def _insert(self, path: str, state: DiscState):
+        self._states[path] = state
+        self._by_status[state.status].add(path)
+        self._by_source_hash[state.source_hash].add(path)
+
+    def _remove(self, path: str):
+        if (state := self._states.pop(path, None)) is None:
+            return
+        self._by_status[state.status].discard(path)
+        paths = self._by_source_hash[state.source_hash]
+        paths.discard(path)
+        if not paths:
+            del self._by_source_hash[state.source_hash]
+
+
+DISCS = DiscIndex()
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_disc_changes(session, _):
+    changes = session.info.setdefault("disc_changes", {})
+    for obj in chain(session.new, session.dirty):
+        if isinstance(obj, Disc):
+            changes[obj.path] = _disc_state(obj, changes.get(obj.path))
+    for obj in session.deleted:
+        if isinstance(obj, Disc):
+            changes[obj.path] = None
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_disc_changes(session):
+    if changes := session.info.pop("disc_changes", None):
+        DISCS.apply(changes)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_disc_changes(session):
+    session.info.pop("disc_changes", None)
+
+
+def _disc_state(disc: Disc, pending: Optional[DiscState]) -> DiscState:
+    # Read only what's loaded, since expired attributes can't be refreshed in
+    # the middle of a flush, and fall back to what's known of the disc.
+    loaded = inspect(disc).dict
+    known = pending or DISCS.get(disc.path)
+
+    def value(name, default=None):
+        if name in loaded:
+            return loaded[name]
+        return getattr(known, name) if known is not None else default
+
+    return DiscState(
+        status=value("status", DiscStatus.RIPPABLE),
+        source_hash=value("source_hash"),
+        next_send_attempt=value("next_send_attempt"),
+    )
+
+
+def _add_columns(conn: Connection, table: Table, *names: str):
+    """Add the named columns of ``table`` that the database doesn't have yet."""
+    existing = {column["name"] for column in inspect(conn).get_columns(table.name)}
+    for name in names:
+        if name in existing:
+            continue
+        column = table.c[name]
+        ddl = f"ALTER TABLE {table.name} ADD COLUMN {name}"
+        ddl += f" {column.type.compile(conn.dialect)}"
+        if column.default is not None and column.default.is_scalar:
+            ddl += f" DEFAULT {column.default.arg!r}"
+        conn.exec_driver_sql(ddl)
+
+
+def _migrate_to_v1(conn: Connection):
+    # Columns added before there were migrations, which a database may have
+    # some of depending on the version that created it.
+    _add_columns(
+        conn,
+        Disc.__table__,
+        "fingerprint",
+        "duplicate_of",
+        "mapfile",
+        "sha256",
+        "send_path",
+        "drive",
+        "size",
+        "ripped_at",
+        "send_offset",
+        "sent_bytes",
+        "send_rate",
+        "send_eta",
+    )
+
+
+def _migrate_to_v2(conn: Connection):
+    _add_columns(
+        conn,
+        Disc.__table__,
+        "drive_id",
+        "rip_started_at",
+        "rip_bytes",
+        "bad_areas",
+        "bad_bytes",
+    )
+
+
+MIGRATIONS = [_migrate_to_v1, _migrate_to_v2]
@@ -0,0 +1,185 @@
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+# See https://www.gnu.org/software/ddrescue/manual/ddrescue_manual.html#Mapfile-structure.
+FINISHED = "+"
+BAD_SECTOR = "-"
+NON_TRIED = "?"
+
+
+@dataclass
+class Block:
+    pos: int
+    size: int
+    status: str
+
+
+@dataclass
+class Mapfile:
+    """
+    The state of a rescue as recorded in a ddrescue mapfile.
+
+    :param current_pos: The position ddrescue was last working on
+    :param current_status: The phase of the rescue that ddrescue was in
+    :param blocks: The status of every block in the rescue domain, in order
+    """
+
+    current_pos: int
+    current_status: str
+    blocks: list[Block]
+
+    @property
+    def rescued_prefix(self) -> int:
+        """The number of bytes from the start of the input known to be rescued."""
+        end = 0
+        for block in self.blocks:
+            if block.pos != end or block.status != FINISHED:
+                break
+            end += block.size
+        return end
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(block.size for block in self.blocks)
+
+    def bytes_with_status(self, status: str) -> int:
+        return sum(block.size for block in self.blocks if block.status == status)
+
+    def areas_with_status(self, status: str) -> int:
+        return sum(1 for block in self.blocks if block.status == status)
+
+
+@dataclass
+class Progress:
+    """
+    A snapshot of how far a rip has gotten.
+
+    :param total_bytes: The size of the rescue domain
+    :param rescued_bytes: The number of bytes read successfully
+    :param bad_bytes: The number of bytes in sectors that failed to read
+    :param bad_areas: The number of distinct areas of failed sectors
+    :param bytes_per_sec: The rate of rescue since the previous snapshot
+    :param rescued_prefix: The number of bytes rescued from the start of the
+        input with no gaps, which ddrescue will never write again
+    """
+
+    total_bytes: int
+    rescued_bytes: int
+    bad_bytes: int
+    bad_areas: int
+    bytes_per_sec: float
+    rescued_prefix: int
+
+    @property
+    def fraction_rescued(self) -> float:
+        return self.rescued_bytes / self.total_bytes if self.total_bytes else 0.0
+
+
+@dataclass
+class ProgressTracker:
+    """
+    Produces :class:`Progress` snapshots from successive reads of a mapfile.
+
+    :param path: The mapfile to read
+    """
+
+    path: str
+
+    _last_time: Optional[float] = field(default=None, init=False)
+    _last_rescued: int = field(default=0, init=False)
+
+    def sample(self) -> Optional[Progress]:
+        """Read the mapfile, or return ``None`` if it isn't readable yet."""
+
+        if (mapfile := read_mapfile(self.path)) is None:
+            return None
+
+        now = time.monotonic()
+        rescued = mapfile.bytes_with_status(FINISHED)
+        rate = 0.0
+        if self._last_time is not None and now > self._last_time:
+            rate = (rescued - self._last_rescued) / (now - self._last_time)
+        self._last_time = now
+        self._last_rescued = rescued
+
+        return Progress(
+            total_bytes=mapfile.total_bytes,
+            rescued_bytes=rescued,
+            bad_bytes=mapfile.bytes_with_status(BAD_SECTOR),
+            bad_areas=mapfile.areas_with_status(BAD_SECTOR),
+            bytes_per_sec=max(rate, 0.0),
+            rescued_prefix=mapfile.rescued_prefix,
+        )
+
+
+def mapfile_path(iso_path: str) -> str:
+    return f"{iso_path}.map"
+
+
+def domain_path(iso_path: str) -> str:
+    return f"{iso_path}.domain"
+
+
+def write_mapfile(path: str, mapfile: Mapfile):
+    """Replace the mapfile at ``path`` atomically."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="ascii") as f:
+        f.write("# Mapfile. Created by isopod\n")
+        f.write(f"0x{mapfile.current_pos:08X}     {mapfile.current_status}     1\n")
+        for block in mapfile.blocks:
+            f.write(f"0x{block.pos:08X}  0x{block.size:08X}  {block.status}\n")
+    os.replace(tmp_path, path)
+
+
+def write_domain_mapfile(path: str, ranges: list[tuple[int, int]], size: int):
+    """
+    Write a mapfile for ``--domain-mapfile`` that limits a rescue of ``size``
+    bytes to the given sorted, non-overlapping ``(pos, size)`` ranges.
+    """
+
+    blocks = []
+    end = 0
+    for pos, length in ranges:
+        if pos > end:
+            blocks.append(Block(end, pos - end, NON_TRIED))
+        blocks.append(Block(pos, length, FINISHED))
+        end = pos + length
+    if end < size:
+        blocks.append(Block(end, size - end, NON_TRIED))
+    write_mapfile(path, Mapfile(current_pos=0, current_status=FINISHED, blocks=blocks))
+
+
+def read_mapfile(path: str) -> Optional[Mapfile]:
+    """
+    Read a ddrescue mapfile, or return ``None`` if it does not exist or can't
+    be parsed (e.g. because ddrescue is in the middle of rewriting it).
+    """
+
+    try:
+        with open(path, encoding="ascii") as f:
+            lines = [
+                line.split()
+                for line in f
+                if line.strip() and not line.lstrip().startswith("#")
+            ]
+    except (FileNotFoundError, UnicodeDecodeError):
+        return None
+
+    if not lines:
+        return None
+
+    try:
+        current_pos, current_status, *_ = lines[0]
+        blocks = [
+            Block(pos=int(pos, 0), size=int(size, 0), status=status)
+            for pos, size, status in lines[1:]
+        ]
+        return Mapfile(
+            current_pos=int(current_pos, 0),
+            current_status=current_status,
+            blocks=blocks,
+        )
+    except ValueError:
+        return None
@@ -0,0 +1,296 @@
+import logging
+import mmap
+import os
+import shlex
+import time
+from abc import ABC, abstractmethod
+from subprocess import DEVNULL, PIPE, Popen
+from typing import Optional
+
+import isopod.ddrescue
+from isopod.controller import Process, ThreadJob
+from isopod.ddrescue import BAD_SECTOR, FINISHED, NON_TRIED, Block, Mapfile
+
+log = logging.getLogger(__name__)
+
+SECTOR_SIZE = 2048
+
+
+class RipEngine(ABC):
+    """
+    A way to copy a disc into an ISO file. Every engine tracks its progress in
+    a ddrescue-compatible mapfile, and resumes from an existing one.
+    """
+
+    required_cmds: tuple[str, ...] = ()
+
+    @abstractmethod
+    def start(
+        self,
+        device_node: str,
+        iso_path: str,
+        mapfile: str,
+        event_log: str,
+        domain: Optional[str] = None,
+    ) -> Process:
+        """
+        Start ripping the disc at ``device_node`` to ``iso_path`` in the
+        background. The process exits with status 0 if and only if the rip
+        finished, even if some sectors could not be read.
+
+        Given a ``domain`` mapfile, only read the blocks it marks as finished,
+        and leave holes in ``iso_path`` for everything else and for blocks of
+        zeros. The ISO may then end short of the disc's full size.
+        """
+
+        pass
+
+
+class DdrescueEngine(RipEngine):
+    """
+    Rips with GNU ddrescue.
+
+    :param journal_output: Whether to send ddrescue's output to the
+        "isopod-ripper" journal namespace
+    """
+
+    required_cmds = ("ddrescue",)
+
+    def __init__(self, journal_output: bool = False):
+        self.journal_output = journal_output
+
+    def start(
+        self,
+        device_node: str,
+        iso_path: str,
+        mapfile: str,
+        event_log: str,
+        domain: Optional[str] = None,
+    ) -> Process:
+        output = self._get_output()
+        args = [
+            "ddrescue",
+            "--idirect",
+            f"--sector-size={SECTOR_SIZE}",
+            "--timeout=30m",
+            f"--log-events={event_log}",
+        ]
+        if domain is not None:
+            args += ["--sparse", f"--domain-mapfile={domain}"]
+        args += [device_node, iso_path, mapfile]
+        try:
+            proc = Popen(args, stdin=DEVNULL, stdout=output, stderr=output)
+        finally:
+            if not isinstance(output, int):
+                output.close()
+
+        log.info("Running: %s", shlex.join(args))
+        return proc
+
+    def _get_output(self):
+        if not self.journal_output:
+            return DEVNULL
+
+        # My desire is to compress and rotate ddrescue's logs to limit their
+        # size without racy copy + truncate logic, regardless of how long
+        # ddrescue runs for. Namespaced journald instances can be frustrating to
+        # work with, since they automatically shut down without a systemd unit
+        # depending on them. However, they work out of the box on many systems,
+        # and I knew enough about them in advance to put this together quickly.
+        # I did look into non-systemd approaches later, but didn't find one
+        # compelling enough to swap this out.
+        args = [
+            "systemd-run",
+            "--pipe",
+            "--quiet",
+            "--collect",
+            "--slice-inherit",
+            "--property=LogNamespace=isopod-ripper",
+            "systemd-cat",
+            "-t",
+            "ddrescue",
+        ]
+        proc = Popen(args, stdin=PIPE, stdout=DEVNULL, stderr=DEVNULL)
+        assert proc.stdin is not None
+        return proc.stdin
+
+
+class NativeEngine(RipEngine):
+    """
+    Rips by reading the device directly with O_DIRECT, into a single aligned
+    buffer that is reused for every read.
+
+    Like ddrescue with Isopod's options, it makes one pass over the disc. When
+    a read fails, it backs off to smaller reads until it has isolated the bad
+    sectors, then grows its reads again after successes. It gives up after 30
+    minutes without a successful read.
+
+    :param max_read_size: The largest read to make, in bytes
+    """
+
+    def __init__(self, max_read_size: int = 256 * SECTOR_SIZE):
+        assert max_read_size % SECTOR_SIZE == 0
+        self.max_read_size = max_read_size
+
+    def start(
+        self,
+        device_node: str,
+        iso_path: str,
+        mapfile: str,
+        event_log: str,
+        domain: Optional[str] = None,
+    ) -> Process:
+        log.info("Natively ripping %s to %s", device_node, iso_path)
+        return NativeRip(device_node, iso_path, mapfile, self.max_read_size, domain)
+
+
+class NativeRip(ThreadJob):
+    TIMEOUT_SEC = 30 * 60
+    MAPFILE_INTERVAL_SEC = 5
+
+    def __init__(
+        self,
+        device_node: str,
+        iso_path: str,
+        mapfile: str,
+        max_read_size: int,
+        domain: Optional[str] = None,
+    ):
+        self.device_node = device_node
+        self.iso_path = iso_path
+        self.mapfile = mapfile
+        self.max_read_size = max_read_size
+        self.domain = domain
+        super().__init__(f"Native rip of {device_node}")
+
+        self._done: list[Block] = []
+        self._start()
+
+    def _work(self) -> int:
+        in_fd = os.open(self.device_node, os.O_RDONLY | os.O_DIRECT)
+        try:
+            out_fd = os.open(self.iso_path, os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                return self._copy(in_fd, out_fd)
+            finally:
+                os.close(out_fd)
+        finally:
+            os.close(in_fd)
+
+    def _copy(self, in_fd: int, out_fd: int) -> int:
+        size = os.lseek(in_fd, 0, os.SEEK_END)
+        existing = isopod.ddrescue.read_mapfile(self.mapfile)
+        todo = existing.blocks if existing else [Block(0, size, NON_TRIED)]
+
+        outside: list[Block] = []
+        if self.domain is not None:
+            if (domain := isopod.ddrescue.read_mapfile(self.domain)) is None:
+                raise OSError(f"Can't read domain mapfile {self.domain}")
+            todo, outside = _split_domain(todo, domain.blocks)
+
+        # An anonymous mapping is page aligned, which satisfies O_DIRECT.
+        buf = mmap.mmap(-1, self.max_read_size)
+        view = memoryview(buf)
+        zeros = memoryview(bytes(self.max_read_size))
+        read_size = self.max_read_size
+        last_success = time.monotonic()
+        last_mapfile = 0.0
+
+        try:
+            for i, block in enumerate(todo):
+                if block.status == FINISHED:
+                    self._mark(block.pos, block.size, FINISHED)
+                    continue
+
+                pos, end = block.pos, block.pos + block.size
+                while pos < end:
+                    if self._stop.is_set():
+                        self._write_mapfile(pos, end, todo[i + 1 :] + outside)
+                        return -15
+
+                    now = time.monotonic()
+                    if now - last_success > self.TIMEOUT_SEC:
+                        log.error("No successful reads in %d seconds", self.TIMEOUT_SEC)
+                        self._write_mapfile(pos, end, todo[i + 1 :] + outside)
+                        return 1
+                    if now - last_mapfile > self.MAPFILE_INTERVAL_SEC:
+                        self._write_mapfile(pos, end, todo[i + 1 :] + outside)
+                        last_mapfile = now
+
+                    n = min(read_size, end - pos)
+                    try:
+                        got = os.preadv(in_fd, [view[:n]], pos)
+                    except OSError:
+                        if read_size > SECTOR_SIZE:
+                            read_size = max(SECTOR_SIZE, read_size // 2)
+                            continue
+                        log.warn("Bad sector at 0x%08X", pos)
+                        self._mark(pos, n, BAD_SECTOR)
+                        pos += n
+                        continue
+
+                    if got == 0:
+                        break
+                    if self.domain is None or view[:got] != zeros[:got]:
+                        os.pwrite(out_fd, view[:got], pos)
+                    self._mark(pos, got, FINISHED)
+                    pos += got
+                    last_success = time.monotonic()
+                    read_size = min(self.max_read_size, read_size * 2)
+        finally:
+            view.release()
+            buf.close()
+
+        for block in outside:
+            self._mark(block.pos, block.size, block.status)
+        self._done.sort(key=lambda block: block.pos)
+        os.fsync(out_fd)
+        self._write_mapfile(size, size, [])
+        return 0
+
+    def _mark(self, pos: int, size: int, status: str):
+        if self._done and self._done[-1].status == status:
+            last = self._done[-1]
+            if last.pos + last.size == pos:
+                last.size += size
+                return
+        self._done.append(Block(pos, size, status))
+
+    def _write_mapfile(self, pos: int, end: int, rest: list[Block]):
+        blocks = list(self._done)
+        if end > pos:
+            blocks.append(Block(pos, end - pos, NON_TRIED))
+        blocks += rest
+        blocks.sort(key=lambda block: block.pos)
+
+        status = NON_TRIED if end > pos or rest else FINISHED
+        isopod.ddrescue.write_mapfile(
+            self.mapfile, Mapfile(current_pos=pos, current_status=status, blocks=blocks)
+        )
+
+
+def _split_domain(
+    blocks: list[Block], domain: list[Block]
+) -> tuple[list[Block], list[Block]]:
+    """
+    Split ``blocks`` into the parts inside the finished blocks of ``domain``,
+    and the parts outside of it.
+    """
+
+    inside, outside = [], []
+    ranges = [(b.pos, b.pos + b.size) for b in domain if b.status == FINISHED]
+    for block in blocks:
+        pos, end = block.pos, block.pos + block.size
+        for start, stop in ranges:
+            if stop <= pos or start >= end:
+                continue
+            if start > pos:
+                outside.append(Block(pos, start - pos, block.status))
+            cut = min(end, stop)
+            inside.append(Block(max(pos, start), cut - max(pos, start), block.status))
+            pos = cut
+            if pos >= end:
+                break
+        if pos < end:
+            outside.append(Block(pos, end - pos, block.status))
+    return inside, outside
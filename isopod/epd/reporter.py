@@ -1,8 +1,6 @@
 import logging
 from dataclasses import dataclass
 
-from sqlalchemy import func, select
-
 from isopod import db
 from isopod.controller import Controller, Reconciled, RepollAfter, Result
 from isopod.epd.display import DISPLAY
@@ -19,6 +17,7 @@ IMAGE_NAMES_BY_STATUS = {
     Status.DISC_INVALID: "unreadable",
     Status.LAST_SUCCEEDED: "success",
     Status.LAST_FAILED: "failure",
+    Status.DUPLICATE: "success",
 }
 
 
@@ -51,12 +50,15 @@ class Reporter(Controller):
                 Status.DISC_INVALID,
                 Status.LAST_SUCCEEDED,
                 Status.LAST_FAILED,
+                Status.DUPLICATE,
             )
         )
         if not skip_ripper_update:
             self._desired.status = ripper_status
 
-        self._desired.disc_count = _count_sendable_discs()
+        self._desired.disc_count = db.DISCS.count(
+            db.DiscStatus.COMPRESSIBLE, db.DiscStatus.SENDABLE
+        )
 
         if self._displayed == self._desired:
             return Reconciled()
@@ -91,13 +93,3 @@ class Reporter(Controller):
 
     def cleanup(self):
         self.reconcile()
-
-
-def _count_sendable_discs():
-    with db.Session() as session:
-        stmt = (
-            select(func.count())
-            .select_from(db.Disc)
-            .filter_by(status=db.DiscStatus.SENDABLE)
-        )
-        return session.execute(stmt).scalar_one()
@@ -0,0 +1,232 @@
+import logging
+from typing import BinaryIO, Optional
+
+log = logging.getLogger(__name__)
+
+# See https://wiki.osdev.org/ISO_9660 and ECMA-119.
+SECTOR_SIZE = 2048
+FIRST_DESCRIPTOR = 16
+MAX_DESCRIPTORS = 32
+MAX_DIRECTORIES = 100_000
+MAX_CONTINUATIONS = 64
+
+BOOT_RECORD = 0
+PRIMARY_DESCRIPTOR = 1
+SUPPLEMENTARY_DESCRIPTOR = 2
+TERMINATOR = 255
+
+# UDF places anchor volume descriptor pointers at sector 256 and in the last
+# sectors of the volume (ECMA-167 3/8.4.2.1). Keep this much of the end of a
+# UDF bridge disc to be sure of catching them.
+UDF_TAIL_SECTORS = 512
+UDF_IDENTIFIERS = (b"BEA01", b"NSR02", b"NSR03", b"TEA01")
+
+Range = tuple[int, int]
+
+
+def find_used_ranges(disc: BinaryIO, size: int) -> Optional[list[Range]]:
+    """
+    Find the byte ranges of a disc image that its ISO 9660 file system uses,
+    sorted and merged, or return ``None`` if the image can't be shown to have
+    unused space.
+
+    Used ranges include the system area and volume descriptors, the path
+    tables, the extents of every directory and file in every directory
+    hierarchy (e.g. Joliet as well as ISO 9660), and the System Use
+    continuation areas that hold Rock Ridge entries that don't fit in a
+    directory record. Anything past the end of the
+    first session's volume is assumed to be used, in case it belongs to a later
+    session.
+
+    UDF structures aren't parsed. On a UDF bridge disc, everything before the
+    first file extent is kept, which is where mastering tools put UDF
+    metadata, along with the anchors at the end of the volume. Discs with only
+    UDF, and bootable discs (whose boot images may be hidden from the
+    directory tree), return ``None``.
+
+    :param disc: The disc, opened for reading in binary mode
+    :param size: The size of the disc in bytes
+    """
+
+    descriptors = []
+    has_udf = False
+    sector = FIRST_DESCRIPTOR
+    for sector in range(FIRST_DESCRIPTOR, FIRST_DESCRIPTOR + MAX_DESCRIPTORS):
+        data = _read(disc, sector, 1)
+        if data[1:6] != b"CD001":
+            break
+        if data[0] == BOOT_RECORD:
+            log.info("Disc is bootable, keeping all sectors")
+            return None
+        if data[0] in (PRIMARY_DESCRIPTOR, SUPPLEMENTARY_DESCRIPTOR):
+            descriptors.append(data)
+        if data[0] == TERMINATOR:
+            break
+    else:
+        return None
+
+    # The UDF volume recognition sequence follows the ISO 9660 descriptors.
+    for vrs_sector in range(sector + 1, sector + 1 + MAX_DESCRIPTORS):
+        ident = _read(disc, vrs_sector, 1)[1:6]
+        if ident not in UDF_IDENTIFIERS:
+            break
+        has_udf = True
+
+    if not descriptors:
+        return None
+
+    block_size = int.from_bytes(descriptors[0][128:130], "little")
+    volume_blocks = int.from_bytes(descriptors[0][80:84], "little")
+    if block_size != SECTOR_SIZE or volume_blocks == 0:
+        return None
+
+    system_end = (vrs_sector + 1) * SECTOR_SIZE
+    used: list[Range] = [(0, system_end)]
+    files: list[Range] = []
+    visited: set[int] = set()  # Directory extents, against loops
+    for descriptor in descriptors:
+        used.extend(_path_tables(descriptor))
+        root = descriptor[156:190]
+        if not _walk(disc, root, used, files, visited):
+            return None
+
+    used.extend(files)
+    if has_udf:
+        first_file = min((pos for pos, length in files if length), default=size)
+        used.append((0, first_file))
+        tail = min(size, UDF_TAIL_SECTORS * SECTOR_SIZE)
+        used.append((size - tail, tail))
+
+    volume_end = volume_blocks * SECTOR_SIZE
+    if volume_end < size:
+        used.append((volume_end, size - volume_end))
+
+    return _merge(used, size)
+
+
+def _path_tables(descriptor: bytes) -> list[Range]:
+    length = int.from_bytes(descriptor[132:136], "little")
+    locations = [
+        int.from_bytes(descriptor[140:144], "little"),
+        int.from_bytes(descriptor[144:148], "little"),
+        int.from_bytes(descriptor[148:152], "big"),
+        int.from_bytes(descriptor[152:156], "big"),
+    ]
+    return [(lba * SECTOR_SIZE, length) for lba in locations if lba != 0]
+
+
+def _walk(
+    disc: BinaryIO,
+    root: bytes,
+    used: list[Range],
+    files: list[Range],
+    visited: set[int],
+) -> bool:
+    """
+    Add the extents of every directory and file under ``root`` to ``used`` and
+    ``files`` respectively. Return False if the tree looks corrupt.
+    """
+
+    pending = [root]
+    while pending:
+        record = pending.pop()
+        pos, length = _extent(record)
+        if pos in visited:
+            continue
+        visited.add(pos)
+        if len(visited) > MAX_DIRECTORIES:
+            log.warn("Too many directories on disc, keeping all sectors")
+            return False
+
+        used.append((pos, length))
+        ear = record[1] * SECTOR_SIZE
+        data = _read(
+            disc, (pos + ear) // SECTOR_SIZE, -(-(length - ear) // SECTOR_SIZE)
+        )
+        for offset in range(0, len(data), SECTOR_SIZE):
+            sector = data[offset : offset + SECTOR_SIZE]
+            i = 0
+            while i < len(sector) and (record_len := sector[i]) > 0:
+                child = sector[i : i + record_len]
+                i += record_len
+                if len(child) < 34:
+                    return False
+
+                # The . record of a directory often points to the continuation
+                # area with Rock Ridge's ER entry, so check every record.
+                if (areas := _continuation_areas(disc, child)) is None:
+                    return False
+                used.extend(areas)
+
+                name_len = child[32]
+                name = child[33 : 33 + name_len]
+                if name in (b"\x00", b"\x01"):  # . and ..
+                    continue
+                if child[25] & 0x02:
+                    pending.append(child)
+                else:
+                    files.append(_extent(child))
+    return True
+
+
+def _continuation_areas(disc: BinaryIO, record: bytes) -> Optional[list[Range]]:
+    """
+    Return the byte ranges of the System Use continuation areas that a
+    directory record's SUSP ``CE`` entries point to, following chains of them,
+    or ``None`` if they look corrupt. See IEEE P1281 (SUSP) section 5.1.
+    """
+
+    name_len = record[32]
+    # A padding byte follows identifiers of even length.
+    start = 33 + name_len + (1 - name_len % 2)
+    areas: list[Range] = []
+    pending = [record[start:]]
+    while pending:
+        data = pending.pop()
+        i = 0
+        while i + 4 <= len(data):
+            signature, length = data[i : i + 2], data[i + 2]
+            if length < 4 or signature == b"ST":
+                break
+            if signature == b"CE" and length >= 28 and i + 28 <= len(data):
+                lba = int.from_bytes(data[i + 4 : i + 8], "little")
+                offset = int.from_bytes(data[i + 12 : i + 16], "little")
+                size = int.from_bytes(data[i + 20 : i + 24], "little")
+                area = (lba * SECTOR_SIZE + offset, size)
+                if area in areas or len(areas) >= MAX_CONTINUATIONS:
+                    return None
+                areas.append(area)
+                disc.seek(area[0])
+                pending.append(disc.read(size))
+            i += length
+    return areas
+
+
+def _extent(record: bytes) -> Range:
+    """Return the byte range of the extent that a directory record points to."""
+    # The extended attribute record, if any, comes before the data.
+    ear_blocks = record[1]
+    lba = int.from_bytes(record[2:6], "little")
+    length = int.from_bytes(record[10:14], "little")
+    return lba * SECTOR_SIZE, ear_blocks * SECTOR_SIZE + length
+
+
+def _read(disc: BinaryIO, lba: int, blocks: int) -> bytes:
+    disc.seek(lba * SECTOR_SIZE)
+    return disc.read(blocks * SECTOR_SIZE)
+
+
+def _merge(ranges: list[Range], size: int) -> list[Range]:
+    """Round ranges out to whole sectors, clip them to ``size``, and merge them."""
+    merged: list[Range] = []
+    for pos, length in sorted(ranges):
+        start = pos - pos % SECTOR_SIZE
+        end = min(size, -(-(pos + length) // SECTOR_SIZE) * SECTOR_SIZE)
+        if end <= start:
+            continue
+        if merged and start <= merged[-1][0] + merged[-1][1]:
+            last_start, last_len = merged[-1]
+            merged[-1] = (last_start, max(last_start + last_len, end) - last_start)
+        else:
+            merged.append((start, end - start))
+    return merged
@@ -1,3 +1,4 @@
+import io
 from functools import cache
 from hashlib import sha256
 from pathlib import Path
@@ -59,6 +60,53 @@ def get_source_hash(dev: str | Device) -> Optional[bytes]:
     return sha256(unit_sep.join((p.encode("utf-8") for p in parts))).digest()
 
 
+def get_content_fingerprint(dev: str | Device) -> Optional[bytes]:
+    """
+    Hash the size, volume descriptors, and a few evenly spaced sectors of the
+    disc in a drive. Unlike the source hash, this stays the same when a disc is
+    ejected and reinserted, and matches between copies of the same disc.
+    """
+
+    # See https://wiki.osdev.org/ISO_9660#Volume_Descriptors.
+    SECTOR_SIZE = 2048
+    TERMINATOR_TYPE = 255
+    MAX_DESCRIPTORS = 32
+    # Every sample costs the drive a seek, which is what keeps this fast enough
+    # to run before every rip.
+    SAMPLE_COUNT = 4
+
+    dev = get_device(dev) if isinstance(dev, str) else dev
+    if dev.device_node is None:
+        return None
+
+    digest = sha256()
+    try:
+        with open(dev.device_node, "rb") as disc:
+            size = disc.seek(0, io.SEEK_END)
+            digest.update(size.to_bytes(8, "big"))
+
+            disc.seek(16 * SECTOR_SIZE)
+            for _ in range(MAX_DESCRIPTORS):
+                sector = disc.read(SECTOR_SIZE)
+                digest.update(sector)
+                if len(sector) < SECTOR_SIZE or sector[0] == TERMINATOR_TYPE:
+                    break
+
+            sectors = size // SECTOR_SIZE
+            for i in range(1, SAMPLE_COUNT + 1):
+                disc.seek((sectors * i // (SAMPLE_COUNT + 1)) * SECTOR_SIZE)
+                digest.update(disc.read(SECTOR_SIZE))
+    except OSError:
+        return None
+    return digest.digest()
+
+
+def get_drive_id(dev: str | Device) -> Optional[str]:
+    """Identify a drive by its model and serial number, which outlive its path."""
+    dev = get_device(dev) if isinstance(dev, str) else dev
+    return dev.properties.get("ID_SERIAL") or dev.properties.get("ID_MODEL")
+
+
 def get_fs_label(dev: str | Device) -> Optional[str]:
     dev = get_device(dev) if isinstance(dev, str) else dev
     return dev.properties.get("ID_FS_LABEL")
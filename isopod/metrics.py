@@ -0,0 +1,365 @@
+import logging
+import math
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Callable, Iterable, Sequence, TypeVar
+
+from isopod.controller import ReconcileTrace
+from isopod.scheduler import Scheduler
+
+log = logging.getLogger(__name__)
+
+LabelValues = tuple[str, ...]
+M = TypeVar("M", bound="Metric")
+
+
+class Metric:
+    """
+    A named family of values in the Prometheus data model, with one value per
+    distinct combination of label values.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = Lock()
+
+    def _key(self, labels: dict[str, str]) -> LabelValues:
+        assert labels.keys() == set(self.labelnames), "labels must match labelnames"
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, values: LabelValues, extra: str = "") -> str:
+        pairs = [
+            f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, values)
+        ]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def expose(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {_escape(self.help)}"
+        yield f"# TYPE {self.name} {self.type}"
+        yield from self._samples()
+
+    def _samples(self) -> Iterable[str]:
+        return ()
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_total(self, value: float, **labels: str):
+        """Mirror a count that's kept elsewhere, for use from collectors."""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in values.items():
+            yield f"{self.name}{self._format_labels(key)} {_number(value)}"
+
+
+class Gauge(Metric):
+    """A value that can go up and down."""
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self._values: dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def remove(self, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            self._values.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in values.items():
+            yield f"{self.name}{self._format_labels(key)} {_number(value)}"
+
+
+class Histogram(Metric):
+    """Counts of observed values in cumulative buckets, plus their sum."""
+
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = (),
+    ):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._counts: dict[LabelValues, list[int]] = {}
+        self._sums: dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * len(self.buckets))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._sums[key] = self._sums.get(key, 0) + value
+
+    def _samples(self):
+        with self._lock:
+            counts = {key: list(c) for key, c in self._counts.items()}
+            sums = dict(self._sums)
+        for key, bucket_counts in counts.items():
+            for bound, count in zip(self.buckets, bucket_counts):
+                le = f'le="{_number(bound)}"'
+                yield f"{self.name}_bucket{self._format_labels(key, le)} {count}"
+            yield f"{self.name}_sum{self._format_labels(key)} {_number(sums[key])}"
+            yield f"{self.name}_count{self._format_labels(key)} {bucket_counts[-1]}"
+
+
+class Registry:
+    """
+    A set of metrics to expose together. Collectors registered with
+    :meth:`add_collector` run before every exposition, to refresh metrics
+    whose values are cheaper to compute on demand than to keep up to date.
+    """
+
+    def __init__(self):
+        self._metrics: list[Metric] = []
+        self._collectors: list[Callable[[], None]] = []
+
+    def register(self, metric: M) -> M:
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, fn: Callable[[], None]):
+        self._collectors.append(fn)
+
+    def expose(self) -> str:
+        for fn in self._collectors:
+            fn()
+        lines = [line for metric in self._metrics for line in metric.expose()]
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+REGISTRY = Registry()
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+TRANSFER_BUCKETS = (60, 300, 600, 1200, 1800, 3600, 7200, 14400, 28800)
+
+RIP_BYTES_PER_SECOND = REGISTRY.register(
+    Gauge(
+        "isopod_rip_bytes_per_second",
+        "Current rescue rate of the in-flight rip",
+        ["drive"],
+    )
+)
+RIP_RESCUED_BYTES = REGISTRY.register(
+    Gauge(
+        "isopod_rip_rescued_bytes",
+        "Bytes rescued so far by the in-flight rip",
+        ["drive"],
+    )
+)
+RIP_BAD_AREAS = REGISTRY.register(
+    Gauge(
+        "isopod_rip_bad_areas",
+        "Areas of unreadable sectors found by the in-flight rip",
+        ["drive"],
+    )
+)
+RIP_BAD_BYTES = REGISTRY.register(
+    Gauge(
+        "isopod_rip_bad_bytes",
+        "Bytes in unreadable sectors found by the in-flight rip",
+        ["drive"],
+    )
+)
+RIP_DURATION_SECONDS = REGISTRY.register(
+    Histogram(
+        "isopod_rip_duration_seconds",
+        "Time taken by finished rips",
+        ["drive", "result"],
+        buckets=TRANSFER_BUCKETS,
+    )
+)
+SEND_BYTES = REGISTRY.register(
+    Counter("isopod_send_bytes_total", "Bytes in ISOs sent successfully")
+)
+SEND_BYTES_PER_SECOND = REGISTRY.register(
+    Gauge("isopod_send_bytes_per_second", "Average rate of the last successful send")
+)
+SEND_DURATION_SECONDS = REGISTRY.register(
+    Histogram(
+        "isopod_send_duration_seconds",
+        "Time taken by finished sends",
+        ["result"],
+        buckets=TRANSFER_BUCKETS,
+    )
+)
+SEND_FAILURES = REGISTRY.register(
+    Counter("isopod_send_failures_total", "Sends that failed and will be retried")
+)
+SEND_ERRORS = REGISTRY.register(
+    Gauge(
+        "isopod_disc_send_errors",
+        "Consecutive failed sends of each disc waiting to be sent",
+        ["disc"],
+    )
+)
+SEND_BACKOFF_SECONDS = REGISTRY.register(
+    Gauge(
+        "isopod_disc_send_backoff_seconds",
+        "Time until each disc waiting to be sent may be retried",
+        ["disc"],
+    )
+)
+SEND_SENT_BYTES = REGISTRY.register(
+    Gauge(
+        "isopod_disc_sent_bytes",
+        "Bytes sent so far by the latest send of each disc waiting to be sent",
+        ["disc"],
+    )
+)
+SEND_RATE_BYTES_PER_SECOND = REGISTRY.register(
+    Gauge(
+        "isopod_disc_send_bytes_per_second",
+        "Current rate of each in-flight send",
+        ["disc"],
+    )
+)
+SEND_ETA_SECONDS = REGISTRY.register(
+    Gauge(
+        "isopod_disc_send_eta_seconds",
+        "Estimated time until each in-flight send finishes",
+        ["disc"],
+    )
+)
+DISCS = REGISTRY.register(
+    Gauge("isopod_discs", "Number of discs known to Isopod", ["status"])
+)
+RECONCILE_SECONDS = REGISTRY.register(
+    Histogram(
+        "isopod_reconcile_duration_seconds",
+        "Time taken by each call to a controller's reconciler",
+        ["controller"],
+        buckets=DURATION_BUCKETS,
+    )
+)
+RECONCILE_LATENCY_SECONDS = REGISTRY.register(
+    Histogram(
+        "isopod_reconcile_latency_seconds",
+        "Time from each controller's earliest pending poll to its reconcile",
+        ["controller"],
+        buckets=DURATION_BUCKETS,
+    )
+)
+RECONCILE_POLLS = REGISTRY.register(
+    Counter(
+        "isopod_reconcile_polls_total",
+        "Polls received by each controller, coalesced or not",
+        ["controller"],
+    )
+)
+
+SCHEDULER_WAKEUPS = REGISTRY.register(
+    Counter(
+        "isopod_scheduler_wakeups_total",
+        "Repoll wakeups that were scheduled, canceled, or fired",
+        ["event"],
+    )
+)
+SCHEDULER_PENDING_WAKEUPS = REGISTRY.register(
+    Gauge("isopod_scheduler_pending_wakeups", "Repoll wakeups waiting to fire")
+)
+SCHEDULER_LATENESS_SECONDS = REGISTRY.register(
+    Counter(
+        "isopod_scheduler_lateness_seconds_total",
+        "Total time between the deadlines of fired wakeups and their callbacks",
+    )
+)
+
+
+def observe_reconcile(trace: ReconcileTrace):
+    """A trace hook that records reconciles in the reconcile metrics."""
+    RECONCILE_SECONDS.observe(trace.duration, controller=trace.name)
+    RECONCILE_LATENCY_SECONDS.observe(trace.latency, controller=trace.name)
+    RECONCILE_POLLS.inc(trace.polls, controller=trace.name)
+
+
+def watch_scheduler(scheduler: Scheduler, registry: Registry = REGISTRY):
+    """Refresh the scheduler metrics from ``scheduler`` before every exposition."""
+
+    def collect():
+        stats = scheduler.stats()
+        SCHEDULER_WAKEUPS.set_total(stats.scheduled, event="scheduled")
+        SCHEDULER_WAKEUPS.set_total(stats.canceled, event="canceled")
+        SCHEDULER_WAKEUPS.set_total(stats.fired, event="fired")
+        SCHEDULER_PENDING_WAKEUPS.set(stats.pending)
+        SCHEDULER_LATENESS_SECONDS.set_total(stats.total_lateness_sec)
+
+    registry.add_collector(collect)
+
+
+def serve(host: str, port: int, registry: Registry = REGISTRY) -> ThreadingHTTPServer:
+    """Expose ``registry`` over HTTP at /metrics from a background thread."""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+
+            body = registry.expose().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    log.info("Serving metrics at http://%s:%d/metrics", host, port)
+    return server
@@ -0,0 +1,121 @@
+import datetime
+import logging
+import re
+import time
+from threading import Thread
+from typing import BinaryIO, Optional
+
+from sqlalchemy import update
+
+from isopod import db
+
+log = logging.getLogger(__name__)
+
+# With --info=progress2, rsync reports on the whole transfer about once a
+# second, with lines separated by carriage returns that look like this:
+#
+#     1,234,567,890  45%   11.22MB/s    0:02:13 (xfr#0, to-chk=1/2)
+#
+# Only the byte count is used. The rate and ETA are worked out here, since
+# rsync's own are rounded for humans and its rate averages over the whole send.
+PROGRESS_LINE = re.compile(rb"^\s*([\d,]+)\s+\d+%")
+LINE_SEPARATOR = re.compile(rb"[\r\n]")
+RATE_SMOOTHING = 0.2
+SAVE_INTERVAL_SEC = 10
+READ_SIZE = 4096
+
+
+class SendProgress:
+    """
+    Follows the progress output of an rsync sending ``disc`` in a background
+    thread. Keeps ``disc.sent_bytes``, ``disc.send_rate``, and
+    ``disc.send_eta`` up to date as it goes, and saves them to the database
+    every so often. Once rsync exits, the rate and ETA are cleared.
+
+    :param disc: The disc being sent
+    :param stream: rsync's standard output
+    :param total: The number of bytes that rsync will send
+    """
+
+    def __init__(self, disc: db.Disc, stream: BinaryIO, total: int):
+        self.disc = disc
+        self.total = total
+        self.rate: Optional[float] = None
+
+        self._stream = stream
+        self._first: Optional[tuple[int, float]] = None
+        self._last: Optional[tuple[int, float]] = None
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def join(self, timeout: Optional[float] = None):
+        self._thread.join(timeout)
+
+    def measured(self) -> Optional[tuple[int, float]]:
+        """
+        The bytes sent and seconds taken between the first and last progress
+        reports, which leave out rsync's startup and file list.
+        """
+
+        if self._first is None or self._last is None:
+            return None
+        return self._last[0] - self._first[0], self._last[1] - self._first[1]
+
+    def _run(self):
+        pending = b""
+        saved = time.monotonic()
+        try:
+            while data := self._stream.read1(READ_SIZE):
+                *lines, pending = LINE_SEPARATOR.split(pending + data)
+                for line in lines:
+                    self._update(line)
+                if time.monotonic() - saved >= SAVE_INTERVAL_SEC:
+                    self._save()
+                    saved = time.monotonic()
+        except OSError as e:
+            log.warn("Lost progress of %s: %s", self.disc.path, e)
+        finally:
+            self._stream.close()
+
+        self.rate = None
+        self.disc.send_rate = None
+        self.disc.send_eta = None
+        self._save()
+
+    def _update(self, line: bytes):
+        if (match := PROGRESS_LINE.match(line)) is None:
+            return
+
+        sent = int(match[1].replace(b",", b""))
+        now = time.monotonic()
+        if self._last is None:
+            self._first = (sent, now)
+        elif now > self._last[1] and sent >= self._last[0]:
+            rate = (sent - self._last[0]) / (now - self._last[1])
+            if self.rate is None:
+                self.rate = rate
+            else:
+                self.rate += RATE_SMOOTHING * (rate - self.rate)
+        self._last = (sent, now)
+
+        self.disc.sent_bytes = sent
+        self.disc.send_rate = self.rate
+        self.disc.send_eta = None
+        if self.rate:
+            remaining = max(0, self.total - sent) / self.rate
+            self.disc.send_eta = datetime.datetime.utcnow() + datetime.timedelta(
+                seconds=remaining
+            )
+
+    def _save(self):
+        with db.Session() as session:
+            session.execute(
+                update(db.Disc)
+                .where(db.Disc.path == self.disc.path)
+                .values(
+                    sent_bytes=self.disc.sent_bytes,
+                    send_rate=self.disc.send_rate,
+                    send_eta=self.disc.send_eta,
+                )
+            )
+            session.commit()
@@ -1,24 +1,43 @@
+import datetime
 import io
 import logging
 import os.path
-import shlex
 import shutil
 import time
+from dataclasses import dataclass
 from enum import Enum, auto
-from subprocess import DEVNULL, PIPE, Popen, TimeoutExpired
-from threading import Thread
+from subprocess import TimeoutExpired
 from typing import Optional
 
 from pyudev import Device, Monitor, MonitorObserver
 from sqlalchemy import select
 
+import isopod.checksum
+import isopod.ddrescue
+import isopod.iso9660
 import isopod.linux
+import isopod.metrics
 import isopod.os
 from isopod import db
-from isopod.controller import Controller, EventSet, Reconciled, RepollAfter, Result
+from isopod.controller import (
+    Controller,
+    EventSet,
+    Process,
+    Reconciled,
+    RepollAfter,
+    Result,
+)
+from isopod.engine import RipEngine
+from isopod.space import SpaceLedger, allocated_bytes
 
 log = logging.getLogger(__name__)
 
+PROGRESS_INTERVAL_SEC = 10
+
+# The sender and other rippers announce the space they free, so this is only
+# a backstop for space freed outside of Isopod.
+SPACE_RECHECK_SEC = 600
+
 
 class Status(Enum):
     UNKNOWN = auto()
@@ -28,6 +47,29 @@ class Status(Enum):
     DISC_INVALID = auto()
     LAST_SUCCEEDED = auto()
     LAST_FAILED = auto()
+    DUPLICATE = auto()
+
+
+class DuplicatePolicy(Enum):
+    """What to do with a disc whose content matches one that was already ripped."""
+
+    RIP = auto()
+    FLAG = auto()
+    SKIP = auto()
+
+
+@dataclass(frozen=True)
+class InspectedDisc:
+    """
+    What the ripper found out about a disc before ripping it, which it keeps
+    while it waits for space rather than reading the drive again each time.
+    """
+
+    source_hash: Optional[bytes]
+    fingerprint: Optional[bytes]
+    duplicate_of: Optional[str]
+    size: int
+    used_ranges: Optional[list[isopod.iso9660.Range]]
 
 
 class Ripper(Controller):
@@ -37,17 +79,38 @@ class Ripper(Controller):
         device_path: str,
         min_free_bytes: int,
         event_log_dir: str,
-        journal_ddrescue_output: bool,
+        engine: RipEngine,
+        space: SpaceLedger,
+        resume: bool = False,
+        duplicates: DuplicatePolicy = DuplicatePolicy.RIP,
+        compress: bool = False,
+        sparse: bool = False,
     ):
         super().__init__()
         self.device_path = device_path
         self.min_free_bytes = min_free_bytes
+        self.space = space
         self.event_log_dir = event_log_dir
-        self.journal_ddrescue_output = journal_ddrescue_output
+        self.engine = engine
+        self.resume = resume
+        self.duplicates = duplicates
+        self.compress = compress
+        self.sparse = sparse
 
         self.on_status_change = EventSet()
+        self.on_progress = EventSet()
 
         self._ripper = None
+        self._rip_path = None
+        self._progress_tracker = None
+        self._progress = None
+        self._hasher = None
+        self._rip_started = None
+        self._rip_size = None
+        self._inspected: Optional[InspectedDisc] = None
+        # Finished rips whose SHA-256 is still being worked out, by path. They
+        # stay RIPPABLE until it's done, and the drive moves on to other discs.
+        self._hashing: dict[str, isopod.checksum.PrefixHasher] = {}
 
         monitor = Monitor.from_netlink(isopod.linux.UDEV.context)
         self._udev_observer = MonitorObserver(monitor, callback=self._update_device)
@@ -56,23 +119,20 @@ class Ripper(Controller):
         self._device = isopod.linux.get_device(self.device_path)
 
         current_source_hash = isopod.linux.get_source_hash(self._device)
-        with db.Session() as session:
-            stmt = (
-                select(db.Disc.source_hash)
-                .filter_by(source_hash=current_source_hash)
-                .where(db.Disc.status != db.DiscStatus.RIPPABLE)
-                .limit(1)
-            )
-            if (found := session.execute(stmt).scalar_one_or_none()) is not None:
-                self._status = Status.LAST_SUCCEEDED
-                self._last_source_hash = found
-            elif isopod.linux.is_fresh_boot():
-                self._status = Status.DRIVE_EMPTY
-                self._last_source_hash = current_source_hash
-            else:
-                self._status = Status.UNKNOWN
-                self._last_source_hash = None
+        if db.DISCS.has_source_hash(
+            current_source_hash,
+            exclude=(db.DiscStatus.RIPPABLE, db.DiscStatus.RESUMABLE),
+        ):
+            self._status = Status.LAST_SUCCEEDED
+            self._last_source_hash = current_source_hash
+        elif isopod.linux.is_fresh_boot():
+            self._status = Status.DRIVE_EMPTY
+            self._last_source_hash = current_source_hash
+        else:
+            self._status = Status.UNKNOWN
+            self._last_source_hash = None
 
+        self.space.on_release.add(self._on_space_released)
         self.poll()
 
     def _update_device(self, dev: Device):
@@ -87,7 +147,15 @@ class Ripper(Controller):
         self._device = dev
         self.poll()
 
+    def _on_space_released(self):
+        if self._status == Status.WAITING_FOR_SPACE:
+            self.poll()
+
     def reconcile(self) -> Result:
+        for path, hasher in list(self._hashing.items()):
+            if hasher.poll() is not None:
+                self._finalize_hash(path, hasher)
+
         source_hash = isopod.linux.get_source_hash(self._device)
         loaded = isopod.linux.is_cdrom_loaded(self._device)
 
@@ -97,7 +165,8 @@ class Ripper(Controller):
 
             match self._ripper.poll():
                 case None:
-                    return Reconciled()
+                    self._update_progress()
+                    return RepollAfter(seconds=PROGRESS_INTERVAL_SEC)
                 case 0:
                     self._finalize_rip_success()
                 case returncode:
@@ -110,51 +179,148 @@ class Ripper(Controller):
             self.status = Status.DRIVE_EMPTY
             return Reconciled()
 
-        if not self._can_read_disc_volume_descriptor():
-            log.warn("Quick read check failed, refusing to rip disc")
-            self.status = Status.DISC_INVALID
-            return Reconciled()
-
-        if (result := self._check_min_free_space()) is not None:
+        inspected = self._inspected
+        if inspected is None or inspected.source_hash != source_hash:
+            self._inspected = None
+            if (inspected := self._inspect_disc(source_hash)) is None:
+                return Reconciled()
+        fingerprint, duplicate_of = inspected.fingerprint, inspected.duplicate_of
+        disc_size, used_ranges = inspected.size, inspected.used_ranges
+
+        resumable = self._find_resumable_disc(fingerprint)
+        iso_filename = resumable.path if resumable else self._get_iso_filename()
+        rip_size = sum(n for _, n in used_ranges) if used_ranges else disc_size
+        if (result := self._check_min_free_space(iso_filename, rip_size)) is not None:
+            self._inspected = inspected
             return result
+        self._inspected = None
+
+        domain = None
+        if used_ranges is not None:
+            domain = isopod.ddrescue.domain_path(iso_filename)
+            isopod.ddrescue.write_domain_mapfile(domain, used_ranges, disc_size)
+            log.info(
+                "File system uses %d of %d bytes, skipping the rest",
+                rip_size,
+                disc_size,
+            )
 
         self._last_source_hash = source_hash
-        iso_filename = self._get_iso_filename()
+        self._rip_path = iso_filename
+        mapfile = (
+            resumable.mapfile
+            if resumable and resumable.mapfile
+            else isopod.ddrescue.mapfile_path(iso_filename)
+        )
         log.info(
-            "Ready to rip %s (diskseq=%s) to %s",
+            "Ready to %s %s (diskseq=%s) to %s",
+            "resume rip of" if resumable else "rip",
             self._device.device_node,
             isopod.linux.get_diskseq(self._device),
             iso_filename,
         )
+        drive_id = isopod.linux.get_drive_id(self._device)
         with db.Session() as session:
-            disc = db.Disc(
-                path=iso_filename,
-                status=db.DiscStatus.RIPPABLE,
-                source_hash=source_hash,
-            )
-            session.add(disc)
+            if resumable:
+                disc = session.merge(resumable)
+                disc.status = db.DiscStatus.RIPPABLE
+                disc.source_hash = source_hash
+                disc.drive = self.device_path
+                disc.drive_id = drive_id
+                disc.rip_started_at = datetime.datetime.utcnow()
+            else:
+                disc = db.Disc(
+                    path=iso_filename,
+                    status=db.DiscStatus.RIPPABLE,
+                    source_hash=source_hash,
+                    fingerprint=fingerprint,
+                    duplicate_of=duplicate_of,
+                    mapfile=mapfile,
+                    drive=self.device_path,
+                    drive_id=drive_id,
+                    rip_started_at=datetime.datetime.utcnow(),
+                )
+                session.add(disc)
             session.commit()
 
-        output = self._get_ripper_output()
-        args = [
-            "ddrescue",
-            "--idirect",
-            "--sector-size=2048",
-            "--timeout=30m",
-            f"--log-events={os.path.join(self.event_log_dir, f'{iso_filename}.log')}",
-            self._device.device_node,
-            iso_filename,
-        ]
-        try:
-            self._ripper = Popen(args, stdin=DEVNULL, stdout=output, stderr=output)
-        finally:
-            if not isinstance(output, int):
-                output.close()
-
-        Thread(target=self._poll_after_rip, daemon=True).start()
-        log.info("Running: %s", shlex.join(args))
+        assert self._device.device_node is not None
+        self._ripper = self.engine.start(
+            device_node=self._device.device_node,
+            iso_path=iso_filename,
+            mapfile=mapfile,
+            event_log=os.path.join(self.event_log_dir, f"{iso_filename}.log"),
+            domain=domain,
+        )
+        self.poll_on_exit(self._ripper)
+        self._progress_tracker = isopod.ddrescue.ProgressTracker(mapfile)
+        self._hasher = isopod.checksum.PrefixHasher(iso_filename)
+        self._rip_started = time.monotonic()
+        self._rip_size = disc_size
         self.status = Status.RIPPING
-        return Reconciled()
+        return RepollAfter(seconds=PROGRESS_INTERVAL_SEC)
+
+    def _inspect_disc(self, source_hash: Optional[bytes]) -> Optional[InspectedDisc]:
+        """
+        Check over the disc in the drive before ripping it, or return ``None``
+        (having updated the status) if it shouldn't be ripped.
+        """
+
+        if not self._can_read_disc_volume_descriptor():
+            log.warn("Quick read check failed, refusing to rip disc")
+            self.status = Status.DISC_INVALID
+            return None
+
+        fingerprint = isopod.linux.get_content_fingerprint(self._device)
+        if (duplicate_of := self._find_duplicate(fingerprint)) is not None:
+            if self.duplicates == DuplicatePolicy.SKIP:
+                log.info("Disc matches already ripped %s, skipping", duplicate_of)
+                self._last_source_hash = source_hash
+                self.status = Status.DUPLICATE
+                return None
+            log.warn("Disc matches already ripped %s", duplicate_of)
+
+        disc_size = self._get_disc_size()
+        used_ranges = self._find_used_ranges(disc_size) if self.sparse else None
+        return InspectedDisc(
+            source_hash, fingerprint, duplicate_of, disc_size, used_ranges
+        )
+
+    def _find_duplicate(self, fingerprint: Optional[bytes]) -> Optional[str]:
+        if self.duplicates == DuplicatePolicy.RIP or fingerprint is None:
+            return None
+
+        with db.Session() as session:
+            stmt = (
+                select(db.Disc.path)
+                .filter_by(fingerprint=fingerprint)
+                .where(
+                    db.Disc.status.in_(
+                        (
+                            db.DiscStatus.COMPRESSIBLE,
+                            db.DiscStatus.SENDABLE,
+                            db.DiscStatus.COMPLETE,
+                        )
+                    )
+                )
+                .limit(1)
+            )
+            return session.execute(stmt).scalar_one_or_none()
+
+    def _find_resumable_disc(self, fingerprint: Optional[bytes]):
+        if not self.resume or fingerprint is None:
+            return None
+
+        with db.Session() as session:
+            stmt = select(db.Disc).filter_by(
+                status=db.DiscStatus.RESUMABLE, fingerprint=fingerprint
+            )
+            for disc in session.execute(stmt).scalars():
+                # Another drive could be resuming a copy of the same disc.
+                if self.space.is_reserved(disc.path):
+                    continue
+                if disc.mapfile and os.path.exists(disc.mapfile):
+                    return disc
+        return None
 
     def _can_read_disc_volume_descriptor(self) -> bool:
         # See https://wiki.osdev.org/ISO_9660#Volume_Descriptors.
@@ -168,11 +334,24 @@ class Ripper(Controller):
             except:
                 return False
 
-    def _check_min_free_space(self) -> Optional[Result]:
+    def _get_disc_size(self) -> int:
         assert self._device.device_node is not None
         with open(self._device.device_node, "rb") as blk:
-            disc_size = blk.seek(0, io.SEEK_END)
-            need_free = disc_size + self.min_free_bytes
+            return blk.seek(0, io.SEEK_END)
+
+    def _find_used_ranges(self, disc_size: int):
+        assert self._device.device_node is not None
+        try:
+            with open(self._device.device_node, "rb") as disc:
+                return isopod.iso9660.find_used_ranges(disc, disc_size)
+        except OSError as e:
+            log.warn("Can't read file system layout, ripping every sector: %s", e)
+            return None
+
+    def _check_min_free_space(
+        self, iso_filename: str, disc_size: int
+    ) -> Optional[Result]:
+        need_free = disc_size + self.min_free_bytes
 
         df = shutil.disk_usage(".")
         if need_free > df.total:
@@ -184,58 +363,84 @@ class Ripper(Controller):
             self.status = Status.LAST_FAILED
             return Reconciled()
 
-        if df.free < need_free:
-            log.info("%d bytes free, waiting for at least %d", df.free, need_free)
+        # Other drives may be partway through their own rips, so the space they
+        # have yet to write out doesn't count as free for this one.
+        reserved = self.space.try_reserve(iso_filename, disc_size, self.min_free_bytes)
+        if not reserved and self._evict_resumable(iso_filename, need_free):
+            reserved = self.space.try_reserve(
+                iso_filename, disc_size, self.min_free_bytes
+            )
+        if not reserved:
+            free = self.space.available()
+            log.info("%d bytes free, waiting for at least %d", free, need_free)
             self.status = Status.WAITING_FOR_SPACE
-            return RepollAfter(seconds=60)
+            return RepollAfter(seconds=SPACE_RECHECK_SEC)
 
         return None
 
+    def _evict_resumable(self, iso_filename: str, need_free: int) -> bool:
+        """
+        Remove partial rips, least recently worked on first, until ``need_free``
+        bytes are free for ``iso_filename``, and return whether that worked. A
+        disc in hand is worth more than ones that may never come back, but
+        nothing is removed if that wouldn't make enough room anyway.
+        """
+
+        with db.Session() as session:
+            stmt = (
+                select(db.Disc)
+                .filter_by(status=db.DiscStatus.RESUMABLE)
+                .where(db.Disc.path != iso_filename)
+                .order_by(db.Disc.rip_started_at.asc().nulls_first(), db.Disc.path)
+            )
+            # Another drive could be resuming one of them right now.
+            evictable = [
+                disc
+                for disc in session.execute(stmt).scalars()
+                if not self.space.is_reserved(disc.path)
+            ]
+            free = self.space.available()
+            held = sum(allocated_bytes(d.path) for d in evictable)
+            if free + held < need_free:
+                return False
+
+            for disc in evictable:
+                if free >= need_free:
+                    break
+                log.info("Removing partial rip %s to make room", disc.path)
+                free += allocated_bytes(disc.path)
+                self._remove_rip(disc)
+                session.delete(disc)
+                session.commit()
+        return True
+
+    def _remove_rip(self, disc: db.Disc):
+        """Remove the ISO of a rip that won't be finished, and its ddrescue files."""
+        self.space.unlink(disc.path)
+        if disc.mapfile:
+            isopod.os.force_unlink(disc.mapfile)
+        isopod.os.force_unlink(isopod.ddrescue.domain_path(disc.path))
+
     def _get_iso_filename(self):
         name = str(time.time_ns())
         if label := isopod.linux.get_fs_label(self._device):
             name += f"_{label}"
         return f"{name}.iso"
 
-    def _get_ripper_output(self):
-        if not self.journal_ddrescue_output:
-            return DEVNULL
-
-        # My desire is to compress and rotate ddrescue's logs to limit their
-        # size without racy copy + truncate logic, regardless of how long
-        # ddrescue runs for. Namespaced journald instances can be frustrating to
-        # work with, since they automatically shut down without a systemd unit
-        # depending on them. However, they work out of the box on many systems,
-        # and I knew enough about them in advance to put this together quickly.
-        # I did look into non-systemd approaches later, but didn't find one
-        # compelling enough to swap this out.
-        args = [
-            "systemd-run",
-            "--pipe",
-            "--quiet",
-            "--collect",
-            "--slice-inherit",
-            "--property=LogNamespace=isopod-ripper",
-            "systemd-cat",
-            "-t",
-            "ddrescue",
-        ]
-        proc = Popen(args, stdin=PIPE, stdout=DEVNULL, stderr=DEVNULL)
-        assert proc.stdin is not None
-        return proc.stdin
-
-    def _poll_after_rip(self):
-        ripper = self._ripper
-        if ripper is not None:
-            ripper.wait()
-            self.poll()
-
     def cleanup(self):
         self._udev_observer.stop()
 
-        if self._ripper is None:
-            return
+        if self._ripper is not None:
+            self._finish_rip()
 
+        if self._hashing:
+            log.info("Waiting for %d rip(s) to finish hashing", len(self._hashing))
+        for path, hasher in list(self._hashing.items()):
+            hasher.wait()
+            self._finalize_hash(path, hasher)
+
+    def _finish_rip(self):
+        assert self._ripper is not None
         log.info("Waiting for in-flight rip to finish")
         disc_changed = False
         while self._try_wait(proc=self._ripper, timeout=2) is None:
@@ -254,7 +459,7 @@ class Ripper(Controller):
             self._finalize_rip_failure(returncode)
 
     @staticmethod
-    def _try_wait(proc: Popen, timeout: int):
+    def _try_wait(proc: Process, timeout: int):
         try:
             return proc.wait(timeout=timeout)
         except TimeoutExpired:
@@ -263,30 +468,142 @@ class Ripper(Controller):
     def _finalize_rip_success(self):
         with db.Session() as session:
             stmt = select(db.Disc).filter_by(
-                status=db.DiscStatus.RIPPABLE, source_hash=self._last_source_hash
+                path=self._rip_path,
+                status=db.DiscStatus.RIPPABLE,
+                source_hash=self._last_source_hash,
             )
             disc = session.execute(stmt).scalar_one()
-            disc.status = db.DiscStatus.SENDABLE
+            if (
+                self._rip_size is not None
+                and os.path.getsize(disc.path) < self._rip_size
+            ):
+                # A sparse rip stops writing after the last used sector.
+                os.truncate(disc.path, self._rip_size)
+            disc.size = os.path.getsize(disc.path)
+            disc.ripped_at = datetime.datetime.utcnow()
+            if self._progress_tracker is not None and (
+                progress := self._progress_tracker.sample()
+            ):
+                disc.rip_bytes = progress.rescued_bytes
+                disc.bad_areas = progress.bad_areas
+                disc.bad_bytes = progress.bad_bytes
             session.commit()
 
+            if self._hasher is not None:
+                # The disc keeps its mapfile until it's hashed, so that a
+                # restart in the meantime can resume the rip if it's enabled.
+                self._hasher.finish()
+                self._hashing[disc.path] = self._hasher
+                self.poll_on_exit(self._hasher)
+            else:
+                self._finalize_hash(disc.path, None)
+
         log.info("Rip succeeded")
+        self._observe_rip_duration("success")
+        self._clear_progress()
+        self._release_rip_space()
         self._ripper = None
         self.status = Status.LAST_SUCCEEDED
 
+    def _finalize_hash(self, path: str, hasher: Optional[isopod.checksum.PrefixHasher]):
+        """Record the SHA-256 of a finished rip, and pass it on to what comes next."""
+        self._hashing.pop(path, None)
+        with db.Session() as session:
+            disc = session.get(db.Disc, path)
+            if disc is None or disc.status != db.DiscStatus.RIPPABLE:
+                return
+            if hasher is not None and hasher.returncode == 0:
+                disc.sha256 = hasher.hexdigest
+                log.info("SHA-256 of %s is %s", disc.path, disc.sha256)
+            elif hasher is not None:
+                log.warn("Couldn't hash %s, sending it without a checksum", path)
+            if self.compress:
+                disc.status = db.DiscStatus.COMPRESSIBLE
+            else:
+                disc.status = db.DiscStatus.SENDABLE
+            session.commit()
+            if disc.mapfile:
+                isopod.os.force_unlink(disc.mapfile)
+            isopod.os.force_unlink(isopod.ddrescue.domain_path(disc.path))
+
     def _finalize_rip_failure(self, returncode: int):
+        if self._hasher is not None:
+            self._hasher.terminate()
         with db.Session() as session:
             stmt = select(db.Disc).filter_by(
-                status=db.DiscStatus.RIPPABLE, source_hash=self._last_source_hash
+                path=self._rip_path,
+                status=db.DiscStatus.RIPPABLE,
+                source_hash=self._last_source_hash,
             )
-            if disc := session.execute(stmt).scalar_one_or_none():
-                isopod.os.force_unlink(disc.path)
+            disc = session.execute(stmt).scalar_one_or_none()
+            if disc and self.resume and disc.mapfile and os.path.exists(disc.mapfile):
+                # Keep the partial rip around to pick up where it left off if
+                # the same disc comes back, rather than throwing away all the
+                # reading that went into it.
+                disc.status = db.DiscStatus.RESUMABLE
+                session.commit()
+                log.info("Saved partial rip %s to resume later", disc.path)
+            elif disc:
+                self._remove_rip(disc)
                 session.delete(disc)
                 session.commit()
 
         log.info("Rip failed with status %d", returncode)
+        self._observe_rip_duration("failure")
+        self._clear_progress()
+        self._release_rip_space()
         self._ripper = None
         self.status = Status.LAST_FAILED
 
+    def _update_progress(self):
+        if self._progress_tracker is None:
+            return
+        if (progress := self._progress_tracker.sample()) is None:
+            return
+
+        last = self._progress
+        if progress.bad_areas > (last.bad_areas if last else 0):
+            log.warn(
+                "Read errors in %d area(s) so far (%d bytes)",
+                progress.bad_areas,
+                progress.bad_bytes,
+            )
+
+        self.progress = progress
+        if self._hasher is not None:
+            self._hasher.update(progress.rescued_prefix)
+
+        drive = self.device_path
+        isopod.metrics.RIP_BYTES_PER_SECOND.set(progress.bytes_per_sec, drive=drive)
+        isopod.metrics.RIP_RESCUED_BYTES.set(progress.rescued_bytes, drive=drive)
+        isopod.metrics.RIP_BAD_AREAS.set(progress.bad_areas, drive=drive)
+        isopod.metrics.RIP_BAD_BYTES.set(progress.bad_bytes, drive=drive)
+
+    def _clear_progress(self):
+        self._progress_tracker = None
+        self._hasher = None
+        self.progress = None
+
+        drive = self.device_path
+        isopod.metrics.RIP_BYTES_PER_SECOND.remove(drive=drive)
+        isopod.metrics.RIP_RESCUED_BYTES.remove(drive=drive)
+        isopod.metrics.RIP_BAD_AREAS.remove(drive=drive)
+        isopod.metrics.RIP_BAD_BYTES.remove(drive=drive)
+
+    def _observe_rip_duration(self, result: str):
+        if self._rip_started is not None:
+            isopod.metrics.RIP_DURATION_SECONDS.observe(
+                time.monotonic() - self._rip_started,
+                drive=self.device_path,
+                result=result,
+            )
+            self._rip_started = None
+
+    def _release_rip_space(self):
+        if self._rip_path is not None:
+            self.space.release(self._rip_path)
+            self._rip_path = None
+
     @property
     def status(self):
         return self._status
@@ -296,3 +613,14 @@ class Ripper(Controller):
         if self._status != value:
             self._status = value
             self.on_status_change.dispatch()
+
+    @property
+    def progress(self) -> Optional[isopod.ddrescue.Progress]:
+        """The most recent progress snapshot for the in-flight rip, if any."""
+        return self._progress
+
+    @progress.setter
+    def progress(self, value: Optional[isopod.ddrescue.Progress]):
+        if self._progress != value:
+            self._progress = value
+            self.on_progress.dispatch()
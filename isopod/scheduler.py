@@ -0,0 +1,103 @@
+import heapq
+import itertools
+import time
+from dataclasses import dataclass, field
+from threading import Condition, Thread
+from typing import Callable
+
+
+@dataclass(order=True)
+class Wakeup:
+    """A callback scheduled with :meth:`Scheduler.call_later`."""
+
+    deadline: float
+    seq: int
+    fn: Callable[[], None] = field(compare=False)
+    canceled: bool = field(compare=False, default=False)
+    fired: bool = field(compare=False, default=False)
+
+
+@dataclass
+class SchedulerStats:
+    """
+    Counters describing a :class:`Scheduler`'s activity since it was created.
+
+    :param scheduled: Wakeups requested through :meth:`Scheduler.call_later`
+    :param canceled: Wakeups canceled before their deadline
+    :param fired: Wakeups whose callbacks ran
+    :param pending: Wakeups currently waiting for their deadline
+    :param total_lateness_sec: Total time between deadlines and callbacks
+    """
+
+    scheduled: int = 0
+    canceled: int = 0
+    fired: int = 0
+    pending: int = 0
+    total_lateness_sec: float = 0.0
+
+
+class Scheduler:
+    """
+    Runs callbacks after delays, from a single thread that sleeps until the
+    earliest deadline in a heap. Scheduling is O(log n), and cancellation marks
+    the entry in place for the thread to discard when it comes up.
+
+    Callbacks run on the scheduler thread, and should return quickly.
+    """
+
+    def __init__(self):
+        self._heap: list[Wakeup] = []
+        self._seq = itertools.count()
+        self._cond = Condition()
+        self._stats = SchedulerStats()
+        self._thread = None
+
+    def call_later(self, seconds: float, fn: Callable[[], None]) -> Wakeup:
+        """Call ``fn`` after ``seconds`` have passed."""
+        deadline = time.monotonic() + seconds
+        with self._cond:
+            self._stats.scheduled += 1
+            wakeup = Wakeup(deadline, next(self._seq), fn)
+            heapq.heappush(self._heap, wakeup)
+            self._stats.pending += 1
+
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True)
+                self._thread.start()
+            if self._heap[0] is wakeup:
+                self._cond.notify()
+            return wakeup
+
+    def cancel(self, wakeup: Wakeup):
+        """Prevent a wakeup from firing, if it hasn't already."""
+        with self._cond:
+            if not wakeup.canceled and not wakeup.fired:
+                wakeup.canceled = True
+                self._stats.canceled += 1
+                self._stats.pending -= 1
+
+    def stats(self) -> SchedulerStats:
+        with self._cond:
+            return SchedulerStats(**vars(self._stats))
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    while self._heap and self._heap[0].canceled:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    delay = self._heap[0].deadline - time.monotonic()
+                    if delay <= 0:
+                        break
+                    self._cond.wait(delay)
+
+                wakeup = heapq.heappop(self._heap)
+                wakeup.fired = True
+                self._stats.pending -= 1
+                self._stats.fired += 1
+                self._stats.total_lateness_sec += time.monotonic() - wakeup.deadline
+
+            wakeup.fn()
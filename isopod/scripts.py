@@ -3,11 +3,13 @@ import isopod.logging
 isopod.logging.configure()
 
 import logging
+import os
 import random
 import shlex
 import signal
 import subprocess
 import sys
+import tempfile
 import time
 from binascii import hexlify
 from subprocess import DEVNULL
@@ -15,8 +17,11 @@ from subprocess import DEVNULL
 import click
 from pyudev import Context, Device, Monitor
 
+import isopod.chunking
+import isopod.engine
 import isopod.epd.images
 import isopod.linux
+import isopod.transport
 from isopod.epd.limit import Bucket, TakeBlocked
 
 log = logging.getLogger(__name__)
@@ -74,6 +79,95 @@ def bucket(capacity, fill_delay, burst_delay):
             time.sleep(random.random())
 
 
+@cli.command(name="rip-bench")
+@click.argument("source", type=click.Path(exists=True, readable=True))
+@click.option(
+    "--engine",
+    "engines",
+    type=click.Choice(["ddrescue", "native"]),
+    multiple=True,
+    default=("ddrescue", "native"),
+    help="An engine to benchmark (repeatable)",
+)
+@click.option(
+    "--outdir",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True, writable=True),
+    default=".",
+    help="The directory to write scratch ISOs in",
+)
+def rip_bench(source, engines, outdir):
+    """
+    Time each rip engine copying SOURCE, e.g. a loop device set up over an ISO
+    with `losetup --find --show --sector-size=2048 disc.iso`.
+    """
+
+    for name in engines:
+        engine: isopod.engine.RipEngine
+        if name == "native":
+            engine = isopod.engine.NativeEngine()
+        else:
+            engine = isopod.engine.DdrescueEngine()
+
+        with tempfile.TemporaryDirectory(dir=outdir) as tmp:
+            iso_path = os.path.join(tmp, "bench.iso")
+            start = time.monotonic()
+            proc = engine.start(
+                device_node=source,
+                iso_path=iso_path,
+                mapfile=os.path.join(tmp, "bench.iso.map"),
+                event_log=os.path.join(tmp, "bench.iso.log"),
+            )
+            returncode = proc.wait()
+            elapsed = time.monotonic() - start
+            size = os.path.getsize(iso_path) if os.path.exists(iso_path) else 0
+
+        rate = size / elapsed / (1024**2) if elapsed > 0 else 0
+        print(f"{name}\t{returncode}\t{size}\t{elapsed:0.2f}s\t{rate:0.2f} MiB/s")
+
+
+@cli.command()
+@click.argument("manifest", type=click.Path(exists=True, dir_okay=False))
+@click.argument("output", type=click.Path(dir_okay=False, writable=True))
+@click.option(
+    "--chunks",
+    type=click.Path(exists=True, file_okay=False, dir_okay=True),
+    default=None,
+    help="The directory of chunks (default: chunks/ next to manifests/)",
+)
+def reassemble(manifest, output, chunks):
+    """Rebuild an ISO from a chunked send's MANIFEST into OUTPUT."""
+    if chunks is None:
+        base = os.path.dirname(os.path.dirname(os.path.abspath(manifest)))
+        chunks = isopod.chunking.chunks_dir(base)
+    try:
+        isopod.chunking.reassemble(manifest, chunks, output)
+    except (OSError, ValueError) as e:
+        log.error("%s", e)
+        sys.exit(1)
+    log.info("Reassembled %s", output)
+
+
+@cli.command()
+@click.argument(
+    "directory", type=click.Path(exists=True, file_okay=False, writable=True)
+)
+@click.option(
+    "--address", type=str, default="127.0.0.1", help="The address to listen on"
+)
+@click.option(
+    "--port",
+    type=int,
+    default=isopod.transport.DEFAULT_PORT,
+    help="The port to listen on",
+)
+def receive(directory, address, port):
+    """Receive ISOs sent with --transport=stream into DIRECTORY."""
+    try:
+        isopod.transport.serve(directory, address, port)
+    except KeyboardInterrupt:
+        pass
+
+
 @cli.group()
 def target():
     """Work with the isopod-target container image."""
@@ -1,88 +1,686 @@
 import datetime
 import logging
+import os.path
 import shlex
-from subprocess import DEVNULL, Popen
-from threading import Thread
+import time
+from dataclasses import dataclass, field
+from enum import Enum, auto
+from subprocess import DEVNULL, PIPE, Popen
+from typing import Optional
 
-from sqlalchemy import select
+from sqlalchemy import func, select
 
+import isopod.checksum
+import isopod.chunking
+import isopod.ddrescue
+import isopod.metrics
 import isopod.os
+import isopod.ssh
 from isopod import db
-from isopod.controller import Controller, EventSet, Reconciled, RepollAfter, Result
+from isopod.bandwidth import BandwidthPolicy
+from isopod.chunking import ChunkJob
+from isopod.controller import Controller, Process, Reconciled, RepollAfter, Result
+from isopod.epd.limit import Bucket, TakeBlocked
+from isopod.progress import SendProgress
+from isopod.space import SpaceLedger
+from isopod.ssh import ControlMaster
+from isopod.transport import Transport
 
 log = logging.getLogger(__name__)
 
+# In pipelined mode, only start an early send of an in-progress rip once
+# ddrescue has rescued this much more of the disc than was already sent, and
+# look for new progress at this interval.
+PIPELINE_MIN_BYTES = 256 * (1024**2)
+PIPELINE_CHECK_SEC = 30
+
+# Early sends build up their copy in this directory under the target, never
+# under the ISO's final name, so a rip that fails can't leave a truncated ISO
+# there. rsync uses that copy as the basis of the final send, then removes it.
+PRESEND_DIR = ".isopod-partial"
+
+# Changing the rate of a running send means restarting rsync, which then has to
+# checksum what it already sent. Allow a few restarts in a row when a window
+# opens or closes, but no more than one every few minutes on average, and only
+# for rate changes large enough to matter.
+RETUNE_BURST = 4
+RETUNE_DELAY_SEC = 300
+RETUNE_TOLERANCE = 0.25
+
+BATCH_MAX_BYTES = 64 * (1024**3)
+
+# Check that the shared SSH connection is still up at this interval. When it
+# keeps dropping, reconnect a few times in a row and then no more than once a
+# minute, while sends fall back to connecting on their own.
+SSH_CHECK_SEC = 60
+SSH_RECONNECT_BURST = 3
+SSH_RECONNECT_DELAY_SEC = 60
+
+
+class QueuePolicy(Enum):
+    """The order in which to send discs that are ready."""
+
+    FIFO = auto()
+    """Send discs in the order their rips finished."""
+
+    SMALLEST = auto()
+    """Send the smallest discs first, to free the most staging space soonest."""
+
+    ROUND_ROBIN = auto()
+    """Take turns between drives, in the order each drive's rips finished."""
+
+    PENALIZED = auto()
+    """Send discs in FIFO order, behind every disc that has failed fewer times."""
+
+
+@dataclass
+class Batch:
+    """
+    An rsync process sending several discs at once, listed in ``files_path``.
+    rsync writes the size and name of each file it sends to ``log_path``.
+    """
+
+    discs: list[db.Disc]
+    proc: Popen
+    files_path: str
+    log_path: str
+    started: float = field(default_factory=time.monotonic)
+
+
+@dataclass
+class Transfer:
+    """
+    A process sending a disc to the target: either rsync or another transport,
+    a remote checksum verification that follows it, or the chunking that comes
+    before a chunked send.
+
+    :param presend_bytes: For an early send of an in-progress rip, the number
+        of bytes that ddrescue had rescued when the send started
+    :param verifying: Whether the process is verifying a finished send
+    :param bwlimit: The rate limit passed to rsync, in KiB per second
+    :param retuning: Whether rsync was stopped to restart at a new rate
+    :param chunks: For a chunked send, the job that split the ISO into chunks
+    :param chunking: Whether the process is splitting the ISO into chunks
+    :param progress: For an rsync send of a single disc, its progress so far
+    :param shared: Whether other sends ran alongside this one at any point, so
+        that its rate doesn't show what the uplink can do
+    """
+
+    disc: db.Disc
+    proc: Process
+    presend_bytes: Optional[int] = None
+    verifying: bool = False
+    bwlimit: Optional[int] = None
+    retuning: bool = False
+    chunks: Optional[ChunkJob] = None
+    chunking: bool = False
+    progress: Optional[SendProgress] = None
+    shared: bool = False
+    started: float = field(default_factory=time.monotonic)
+
 
 class Sender(Controller):
-    def __init__(self, target_base: str):
+    def __init__(
+        self,
+        target_base: str,
+        concurrency: int = 1,
+        pipeline: bool = False,
+        verify_remote: bool = False,
+        space: Optional[SpaceLedger] = None,
+        bandwidth: Optional[BandwidthPolicy] = None,
+        queue_policy: QueuePolicy = QueuePolicy.FIFO,
+        sparse: bool = False,
+        chunked: bool = False,
+        batch_max_discs: int = 1,
+        batch_max_bytes: int = BATCH_MAX_BYTES,
+        multiplex: bool = False,
+        transport: Optional[Transport] = None,
+    ):
         super().__init__()
         self.target_base = target_base
+        self.concurrency = concurrency
+        self.pipeline = pipeline
+        self.verify_remote = verify_remote
+        self.space = space
+        self.bandwidth = bandwidth
+        self.queue_policy = queue_policy
+        self.sparse = sparse
+        self.chunked = chunked
+        self.batch_max_discs = batch_max_discs
+        self.batch_max_bytes = batch_max_bytes
+        self.transport = transport
 
-        self.on_send_success = EventSet()
+        self._transfers: dict[str, Transfer] = {}
+        self._batches: list[Batch] = []
+        self._present_bytes: dict[str, int] = {}
+        self._retunes = Bucket(
+            capacity=RETUNE_BURST, fill_delay=RETUNE_DELAY_SEC, burst_delay=0
+        )
+        # Paths whose last send was cut short, leaving a partial copy on the
+        # target that makes their next send look faster than the uplink is.
+        self._partial: set[str] = set()
 
-        self._rsync = None
-        self._current_disc = None
+        self._master: Optional[ControlMaster] = None
+        ssh_target = parse_ssh_target(target_base) if transport is None else None
+        if multiplex and ssh_target is not None:
+            self._master = ControlMaster(ssh_target[0], check_interval=SSH_CHECK_SEC)
+        self._reconnects = Bucket(
+            capacity=SSH_RECONNECT_BURST,
+            fill_delay=SSH_RECONNECT_DELAY_SEC,
+            burst_delay=0,
+        )
 
         self.poll()
 
     def reconcile(self) -> Result:
-        if self._rsync is not None:
-            match self._rsync.poll():
+        for transfer in list(self._transfers.values()):
+            if transfer.progress is not None and transfer.proc.poll() is not None:
+                # Let the last progress report land on the disc before it's
+                # merged back into the database.
+                transfer.progress.join()
+
+            match transfer.proc.poll():
                 case None:
-                    return Reconciled()
+                    pass
+                case _ if transfer.retuning:
+                    del self._transfers[transfer.disc.path]
+                case returncode if transfer.presend_bytes is not None:
+                    self._finalize_presend(transfer, returncode)
+                case 0 if transfer.chunking:
+                    self._start_chunk_upload(transfer)
+                case 0 if self._should_verify(transfer):
+                    self._record_bandwidth(transfer)
+                    self._start_verify(transfer)
                 case 0:
-                    self._finalize_rsync_success()
+                    self._record_bandwidth(transfer)
+                    self._finalize_rsync_success(transfer)
                 case _:
-                    self._finalize_rsync_failure()
+                    self._finalize_rsync_failure(transfer)
+
+        for batch in list(self._batches):
+            if (returncode := batch.proc.poll()) is not None:
+                self._finalize_batch(batch, returncode)
 
-        if (disc := self._get_next_disc()) is None:
+        bandwidth_delay = self._reconcile_bandwidth()
+        if (ssh_delay := self._reconcile_master()) is not None:
+            bandwidth_delay = min(bandwidth_delay or ssh_delay, ssh_delay)
+
+        free_slots = self.concurrency - len(self._transfers) - len(self._batches)
+        if free_slots <= 0:
+            if bandwidth_delay is not None:
+                return RepollAfter(seconds=bandwidth_delay)
             return Reconciled()
 
-        if disc.next_send_attempt is not None:
-            delay = disc.next_send_attempt - datetime.datetime.utcnow()
-            delay_sec = delay.total_seconds()
-            if delay_sec > 0:
-                log.info("Will retry after %0.1f second(s)", delay_sec)
-                return RepollAfter(seconds=delay_sec)
-
-        args = ["rsync", "--partial", disc.path, f"{self.target_base}/{disc.path}"]
-        self._rsync = Popen(args, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
-        self._current_disc = disc
-        Thread(target=self._poll_after_rsync, daemon=True).start()
-        log.info("Started: %s", shlex.join(args))
+        retry_delay = bandwidth_delay
+        now = datetime.datetime.utcnow()
+        due_paths, next_attempt = db.DISCS.due(db.DiscStatus.SENDABLE, now)
+        due_paths -= set(self._transfers.keys())
+        due_paths -= {disc.path for batch in self._batches for disc in batch.discs}
+        due = self._get_queued_discs(due_paths) if due_paths else []
+
+        if self.batch_max_discs > 1:
+            free_slots -= self._start_batches(due, free_slots)
+        else:
+            for disc in due[:free_slots]:
+                self._start_transfer(disc)
+                free_slots -= 1
+
+        if free_slots > 0 and next_attempt is not None:
+            delay_sec = (next_attempt - now).total_seconds()
+            log.info("Will retry after %0.1f second(s)", delay_sec)
+            retry_delay = min(retry_delay or delay_sec, delay_sec)
+
+        if self.pipeline and (check_delay := self._reconcile_presends(free_slots)):
+            retry_delay = min(retry_delay or check_delay, check_delay)
+
+        if retry_delay is not None:
+            return RepollAfter(seconds=retry_delay)
         return Reconciled()
 
+    def _reconcile_presends(self, free_slots: int) -> Optional[float]:
+        """
+        Start early sends for in-progress rips that have made enough progress,
+        and return how long to wait before checking them again (if needed).
+        """
+
+        ripping = self._get_ripping_discs()
+        ripping_paths = {disc.path for disc in ripping}
+        for path in self._present_bytes.keys() - ripping_paths:
+            del self._present_bytes[path]
+
+        for disc in ripping:
+            if free_slots <= 0:
+                break
+            if disc.path in self._transfers or disc.mapfile is None:
+                continue
+
+            if (mapfile := isopod.ddrescue.read_mapfile(disc.mapfile)) is None:
+                continue
+
+            rescued = mapfile.rescued_prefix
+            if rescued - self._present_bytes.get(disc.path, 0) < PIPELINE_MIN_BYTES:
+                continue
+
+            self._start_transfer(disc, presend_bytes=rescued)
+            free_slots -= 1
+
+        return PIPELINE_CHECK_SEC if ripping else None
+
+    def _reconcile_bandwidth(self) -> Optional[float]:
+        """
+        Restart sends whose rate limit no longer matches the bandwidth policy,
+        and return how long to wait before the policy next changes (if ever).
+        """
+
+        if self.bandwidth is None:
+            return None
+
+        now = datetime.datetime.now()
+        delay = self.bandwidth.seconds_until_change(now)
+        bwlimit = self.bandwidth.transfer_limit(now, self.concurrency)
+        for transfer in self._transfers.values():
+            if transfer.verifying or transfer.retuning or transfer.chunking:
+                continue
+            if not _bwlimit_changed(transfer.bwlimit, bwlimit):
+                continue
+
+            try:
+                self._retunes.take()
+            except TakeBlocked as e:
+                delay = min(delay or e.seconds_remaining, e.seconds_remaining)
+                break
+
+            log.info(
+                "Restarting send of %s at %s",
+                transfer.disc.path,
+                f"{bwlimit} KiB/s" if bwlimit is not None else "full speed",
+            )
+            transfer.retuning = True
+            self._partial.add(transfer.disc.path)
+            transfer.proc.terminate()
+
+        return delay
+
+    def _reconcile_master(self) -> Optional[float]:
+        """
+        (Re)connect the shared SSH connection if it's down, and return how long
+        to wait before checking it again.
+        """
+
+        if self._master is None:
+            return None
+        if self._master.healthy():
+            if (check := self._master.check()) is not None:
+                self.poll_on_exit(check)
+            if self._master.checking:
+                # Come back to give up on a check that hangs.
+                return isopod.ssh.CHECK_TIMEOUT_SEC
+            return SSH_CHECK_SEC
+
+        try:
+            self._reconnects.take()
+        except TakeBlocked as e:
+            return e.seconds_remaining
+
+        if self._master.proc is not None:
+            log.warn("SSH connection to %s was lost, reconnecting", self._master.host)
+        self._master.start()
+        assert self._master.proc is not None
+        self.poll_on_exit(self._master.proc)
+        return SSH_CHECK_SEC
+
+    def _record_bandwidth(self, transfer: Transfer):
+        path = transfer.disc.path
+        if (
+            self.bandwidth is None
+            or self.pipeline
+            or transfer.bwlimit is not None
+            or transfer.presend_bytes is not None
+            or transfer.chunks is not None
+            or transfer.shared
+            or path in self._partial
+        ):
+            return
+
+        if transfer.progress is not None and (measured := transfer.progress.measured()):
+            self.bandwidth.record(*measured)
+            return
+
+        elapsed = time.monotonic() - transfer.started
+        self.bandwidth.record(os.path.getsize(transfer.disc.staged_path), elapsed)
+
     def cleanup(self):
-        if self._rsync is not None:
-            log.info("Canceling in-flight send")
-            self._rsync.terminate()
-            self._rsync.wait()
+        procs = [t.proc for t in self._transfers.values()]
+        procs += [b.proc for b in self._batches]
+        if procs:
+            log.info("Canceling %d in-flight send(s)", len(procs))
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait()
+        for batch in self._batches:
+            isopod.os.force_unlink(batch.files_path)
+            isopod.os.force_unlink(batch.log_path)
+        if self._master is not None:
+            self._master.close()
 
-    def _finalize_rsync_success(self):
-        with db.Session() as session:
-            disc = self._current_disc
-            assert disc is not None
+    def _start_batches(self, discs: list[db.Disc], slots: int) -> int:
+        """
+        Send ``discs`` in as few batches as the batch limits allow, using at
+        most ``slots`` batches, and return the number of batches started.
+        """
+
+        started = 0
+        discs = list(discs)
+        while discs and started < slots:
+            batch, batch_bytes = [], 0
+            while discs and len(batch) < self.batch_max_discs:
+                size = os.path.getsize(discs[0].staged_path)
+                if batch and batch_bytes + size > self.batch_max_bytes:
+                    break
+                batch.append(discs.pop(0))
+                batch_bytes += size
+
+            self._start_batch(batch)
+            started += 1
+        return started
+
+    def _start_batch(self, discs: list[db.Disc]):
+        name = f"batch-{time.time_ns()}"
+        files_path, log_path = f"{name}.files", f"{name}.log"
+        with open(files_path, "w", encoding="utf8") as f:
+            for disc in discs:
+                f.write(f"{disc.staged_path}\n")
+                if disc.sha256:
+                    isopod.checksum.write_sidecar(disc.path, disc.sha256)
+                    f.write(f"{isopod.checksum.sidecar_path(disc.path)}\n")
+
+        args = [
+            *self._rsync(),
+            f"--files-from={files_path}",
+            # With a transfer statistic like %b in the format, rsync only logs
+            # each file after it has finished sending it, not before.
+            "--out-format=%b %n",
+        ]
+        if (bwlimit := self._bwlimit()) is not None:
+            args.append(f"--bwlimit={bwlimit}")
+        if self.sparse:
+            args.append("--sparse")
+        args += [".", f"{self.target_base}/"]
 
-            self._rsync = None
-            self._current_disc = None
+        with open(log_path, "w", encoding="utf8") as out:
+            rsync = Popen(args, stdin=DEVNULL, stdout=out, stderr=DEVNULL)
+        self._share_uplink()
+        self._batches.append(Batch(discs, rsync, files_path, log_path))
+        self.poll_on_exit(rsync)
+        log.info("Started batch of %d disc(s): %s", len(discs), shlex.join(args))
 
+    def _finalize_batch(self, batch: Batch, returncode: int):
+        self._batches.remove(batch)
+        if returncode == 0:
+            sent = {disc.staged_path for disc in batch.discs}
+        else:
+            # rsync logs each file once it has sent all of it, so those files
+            # made it even though others failed.
+            with open(batch.log_path, encoding="utf8", errors="replace") as f:
+                sent = {line.rstrip("\n").partition(" ")[2] for line in f}
+            log.info("Batch send failed with status %d", returncode)
+        isopod.os.force_unlink(batch.files_path)
+        isopod.os.force_unlink(batch.log_path)
+
+        for disc in batch.discs:
+            transfer = Transfer(disc=disc, proc=batch.proc, started=batch.started)
+            if disc.staged_path not in sent:
+                self._finalize_rsync_failure(transfer)
+            elif self._should_verify(transfer):
+                self._transfers[disc.path] = transfer
+                self._start_verify(transfer)
+            else:
+                self._finalize_rsync_success(transfer)
+
+    def _start_transfer(self, disc: db.Disc, presend_bytes: Optional[int] = None):
+        if self.chunked and presend_bytes is None and self._reserve_staging(disc):
+            staging = isopod.chunking.staging_path(disc.path)
+            job = ChunkJob(disc.staged_path, staging, sha256=disc.sha256)
+            self._transfers[disc.path] = Transfer(
+                disc=disc,
+                proc=job,
+                chunks=job,
+                chunking=True,
+                shared=self._share_uplink(),
+            )
+            self.poll_on_exit(job)
+            log.info("Chunking %s into %s", disc.staged_path, staging)
+            return
+
+        if self.transport is not None and presend_bytes is None:
+            bwlimit = self._bwlimit()
+            proc = self.transport.start(disc, bwlimit)
+            self._transfers[disc.path] = Transfer(
+                disc=disc, proc=proc, bwlimit=bwlimit, shared=self._share_uplink()
+            )
+            self.poll_on_exit(proc)
+            log.info(
+                "Started sending %s with %s",
+                disc.staged_path,
+                type(self.transport).__name__,
+            )
+            return
+
+        args = [*self._rsync(partial=presend_bytes is None), "--info=progress2"]
+        bwlimit = self._bwlimit()
+        if bwlimit is not None:
+            args.append(f"--bwlimit={bwlimit}")
+        if presend_bytes is not None:
+            # Early sends only ever extend the copy on the target. Anything
+            # ddrescue fills in behind them is picked up by the final send.
+            args.append("--append")
+        if self.sparse and presend_bytes is None:
+            # rsync can't combine --sparse with the in-place writes of --append.
+            args.append("--sparse")
+        args.append(disc.staged_path)
+
+        if presend_bytes is None and disc.sha256:
+            # The sidecar sorts after an uncompressed ISO, so rsync only sends
+            # it once the ISO itself is in place.
+            isopod.checksum.write_sidecar(disc.path, disc.sha256)
+            args.append(isopod.checksum.sidecar_path(disc.path))
+        if presend_bytes is not None:
+            args.append(f"{self.target_base}/{PRESEND_DIR}/")
+        else:
+            args.append(f"{self.target_base}/")
+
+        rsync = Popen(args, stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL)
+        assert rsync.stdout is not None
+        if presend_bytes is not None:
+            total = presend_bytes - self._present_bytes.get(disc.path, 0)
+        else:
+            total = os.path.getsize(disc.staged_path)
+        self._transfers[disc.path] = Transfer(
+            disc=disc,
+            proc=rsync,
+            presend_bytes=presend_bytes,
+            bwlimit=bwlimit,
+            progress=SendProgress(disc, rsync.stdout, total),
+            shared=self._share_uplink(),
+        )
+        self.poll_on_exit(rsync)
+        log.info("Started: %s", shlex.join(args))
+
+    def _share_uplink(self) -> bool:
+        """
+        Note that a new send is starting alongside any running ones, and return
+        whether there are any.
+        """
+
+        for transfer in self._transfers.values():
+            transfer.shared = True
+        return bool(self._transfers or self._batches)
+
+    def _rsync(self, partial: bool = True) -> list[str]:
+        """
+        The start of an rsync command line to the target, which keeps partial
+        files if ``partial``. In pipelined mode, partial files go where early
+        sends leave theirs, so that the final send picks up from either.
+        """
+
+        args = ["rsync"]
+        if partial and self.pipeline:
+            args.append(f"--partial-dir={PRESEND_DIR}")
+        elif partial:
+            args.append("--partial")
+        if self._master is not None:
+            args += ["--rsh", shlex.join(self._ssh())]
+        return args
+
+    def _ssh(self) -> list[str]:
+        """The start of an ssh command line to the target's host."""
+        if self._master is None:
+            return ["ssh"]
+        return ["ssh", *self._master.client_options()]
+
+    def _bwlimit(self) -> Optional[int]:
+        if self.bandwidth is None:
+            return None
+        return self.bandwidth.transfer_limit(datetime.datetime.now(), self.concurrency)
+
+    def _reserve_staging(self, disc: db.Disc) -> bool:
+        if self.space is None:
+            return True
+
+        # The chunks to stage can't add up to more than the ISO itself.
+        staging = isopod.chunking.staging_path(disc.path)
+        size = os.path.getsize(disc.staged_path)
+        if self.space.try_reserve(staging, size, keep_free=0):
+            return True
+        log.info("Not enough space to stage chunks of %s, sending whole", disc.path)
+        return False
+
+    def _start_chunk_upload(self, transfer: Transfer):
+        disc = transfer.disc
+        assert transfer.chunks is not None
+        stats = transfer.chunks.stats
+        log.info(
+            "%s has %d chunk(s), %d new (%d bytes)",
+            disc.path,
+            stats.chunks,
+            len(stats.new),
+            stats.new_bytes,
+        )
+
+        # Without --partial, rsync only puts complete files under their final
+        # names, which --ignore-existing can then safely skip on a retry.
+        args = [*self._rsync(partial=False), "--recursive", "--ignore-existing"]
+        bwlimit = self._bwlimit()
+        if bwlimit is not None:
+            args.append(f"--bwlimit={bwlimit}")
+        args += [f"{transfer.chunks.staging}/", f"{self.target_base}/"]
+
+        rsync = Popen(args, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+        transfer.proc = rsync
+        transfer.chunking = False
+        transfer.bwlimit = bwlimit
+        self.poll_on_exit(rsync)
+        log.info("Started: %s", shlex.join(args))
+
+    def _remove_staging(self, transfer: Transfer):
+        if transfer.chunks is None:
+            return
+        isopod.chunking.remove_staging(transfer.chunks.staging)
+        if self.space is not None:
+            self.space.release(transfer.chunks.staging)
+
+    def _should_verify(self, transfer: Transfer) -> bool:
+        # Other transports check the SHA-256 on the target as they finish.
+        return (
+            self.verify_remote
+            and self.transport is None
+            and not transfer.verifying
+            and transfer.chunks is None
+            and transfer.disc.sha256 is not None
+        )
+
+    def _start_verify(self, transfer: Transfer):
+        disc = transfer.disc
+        if (ssh_target := parse_ssh_target(self.target_base)) is None:
+            log.warn("Can't verify %s on a non-SSH target", disc.path)
+            self._finalize_rsync_success(transfer)
+            return
+
+        host, remote_dir = ssh_target
+        if disc.send_path is not None:
+            # The sidecar describes the ISO, so check the decompressed stream.
+            assert disc.sha256 is not None
+            decompress = shlex.join(["zstd", "-dcq", "--", disc.send_path])
+            remote_cmd = (
+                f'test "$({decompress} | sha256sum | cut -c1-64)" = {disc.sha256}'
+            )
+        else:
+            remote_cmd = shlex.join(
+                [
+                    "sha256sum",
+                    "--check",
+                    "--status",
+                    isopod.checksum.sidecar_path(disc.path),
+                ]
+            )
+        args = [
+            *self._ssh(),
+            host,
+            f"cd {shlex.quote(remote_dir or '.')} && {remote_cmd}",
+        ]
+        proc = Popen(args, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+        transfer.proc = proc
+        transfer.verifying = True
+        self.poll_on_exit(proc)
+        log.info("Started: %s", shlex.join(args))
+
+    def _finalize_presend(self, transfer: Transfer, returncode: int):
+        disc = transfer.disc
+        del self._transfers[disc.path]
+
+        # A failed early send only leaves more work for the final send, so it
+        # doesn't count toward the disc's retry backoff.
+        if returncode == 0:
+            assert transfer.presend_bytes is not None
+            self._present_bytes[disc.path] = transfer.presend_bytes
+            log.info("Sent first %d bytes of %s", transfer.presend_bytes, disc.path)
+        else:
+            log.info("Early send of %s failed with status %d", disc.path, returncode)
+
+    def _finalize_rsync_success(self, transfer: Transfer):
+        with db.Session() as session:
+            disc = transfer.disc
+            self._transfers.pop(disc.path, None)
+            self._partial.discard(disc.path)
+
+            if transfer.chunks is not None:
+                isopod.chunking.record_sent(disc.path, transfer.chunks.stats)
             disc.status = db.DiscStatus.COMPLETE
             session.merge(disc)
             session.commit()
-            isopod.os.force_unlink(disc.path)
-            log.info("Sent and cleaned up %s", disc.path)
-
-        self.on_send_success.dispatch()
+            self._remove_staging(transfer)
+            size = os.path.getsize(disc.staged_path)
+            self._observe_send(transfer, "success", size)
+            isopod.os.force_unlink(isopod.checksum.sidecar_path(disc.path))
+            if self.space is not None:
+                self.space.unlink(disc.staged_path)
+            else:
+                isopod.os.force_unlink(disc.staged_path)
+            log.info("Sent and cleaned up %s", disc.staged_path)
 
-    def _finalize_rsync_failure(self):
+    def _finalize_rsync_failure(self, transfer: Transfer):
         with db.Session() as session:
-            disc = self._current_disc
-            assert disc is not None
-
-            self._rsync = None
-            self._current_disc = None
+            disc = transfer.disc
+            self._transfers.pop(disc.path, None)
 
-            log.info("Failed to send %s", disc.path)
+            self._remove_staging(transfer)
+            if transfer.verifying:
+                log.info("Remote checksum of %s did not match", disc.path)
+            else:
+                log.info("Failed to send %s", disc.path)
+                self._partial.add(disc.path)
+            self._observe_send(transfer, "failure")
             disc.send_errors += 1
             retry_base_sec = 5
             retry_max_sec = 300
@@ -94,17 +692,87 @@ class Sender(Controller):
             session.merge(disc)
             session.commit()
 
-    def _get_next_disc(self):
+    def _observe_send(
+        self, transfer: Transfer, result: str, size: Optional[int] = None
+    ):
+        elapsed = time.monotonic() - transfer.started
+        with db.Session() as session:
+            session.add(
+                db.SendAttempt(
+                    disc=transfer.disc.path,
+                    started_at=datetime.datetime.utcnow()
+                    - datetime.timedelta(seconds=elapsed),
+                    duration_sec=elapsed,
+                    bytes=size if size is not None else transfer.disc.sent_bytes,
+                    result=result,
+                    concurrency=self.concurrency,
+                    bwlimit=transfer.bwlimit,
+                )
+            )
+            session.commit()
+
+        isopod.metrics.SEND_DURATION_SECONDS.observe(elapsed, result=result)
+        if size is not None:
+            isopod.metrics.SEND_BYTES.inc(size)
+            isopod.metrics.SEND_BYTES_PER_SECOND.set(size / max(elapsed, 1e-3))
+        else:
+            isopod.metrics.SEND_FAILURES.inc()
+
+    def _get_queued_discs(self, paths: set[str]):
+        """
+        Return the discs at ``paths`` that are waiting to be sent, in the order
+        of the queue policy.
+        """
+
+        fifo = (
+            db.Disc.ripped_at.asc().nulls_last(),
+            db.Disc.next_send_attempt.asc(),
+            db.Disc.path.asc(),
+        )
+        match self.queue_policy:
+            case QueuePolicy.FIFO:
+                order = fifo
+            case QueuePolicy.SMALLEST:
+                order = (db.Disc.size.asc().nulls_last(), *fifo)
+            case QueuePolicy.ROUND_ROBIN:
+                turn = func.row_number().over(partition_by=db.Disc.drive, order_by=fifo)
+                order = (turn.asc(), *fifo)
+            case QueuePolicy.PENALIZED:
+                order = (db.Disc.send_errors.asc(), *fifo)
+
         with db.Session() as session:
             stmt = (
                 select(db.Disc)
                 .filter_by(status=db.DiscStatus.SENDABLE)
-                .order_by(db.Disc.next_send_attempt.asc())
+                .where(db.Disc.path.in_(paths))
+                .order_by(*order)
             )
-            return session.execute(stmt).scalars().first()
+            return session.execute(stmt).scalars().all()
+
+    def _get_ripping_discs(self):
+        if not db.DISCS.count(db.DiscStatus.RIPPABLE):
+            return []
+        with db.Session() as session:
+            stmt = select(db.Disc).filter_by(status=db.DiscStatus.RIPPABLE)
+            return session.execute(stmt).scalars().all()
+
+
+def _bwlimit_changed(old: Optional[int], new: Optional[int]) -> bool:
+    if old is None or new is None:
+        return old != new
+    return abs(new - old) > RETUNE_TOLERANCE * old
+
+
+def parse_ssh_target(target: str) -> Optional[tuple[str, str]]:
+    """
+    Split an rsync target of the form ``[user@]host:path`` into its host and
+    path, or return ``None`` for rsync daemon targets and local paths.
+    """
+
+    if target.startswith("rsync://"):
+        return None
 
-    def _poll_after_rsync(self):
-        rsync = self._rsync
-        if rsync is not None:
-            rsync.wait()
-            self.poll()
+    host, sep, path = target.partition(":")
+    if not sep or "/" in host or path.startswith(":"):
+        return None
+    return host, path
@@ -0,0 +1,88 @@
+import logging
+import os
+import shutil
+from threading import Lock
+
+import isopod.os
+from isopod.controller import EventSet
+
+log = logging.getLogger(__name__)
+
+
+class SpaceLedger:
+    """
+    Tracks the space that in-flight work has promised to consume in a
+    directory, so that concurrent writers don't each assume that all of the
+    free space in the filesystem belongs to them.
+
+    Anything waiting for space can subscribe to :attr:`on_release`, which fires
+    whenever a reservation is dropped or a file is removed through the ledger.
+
+    :param root: The directory whose filesystem is being accounted for
+    """
+
+    def __init__(self, root: str = "."):
+        self.root = root
+        self.on_release = EventSet()
+        self._lock = Lock()
+        self._reserved: dict[str, int] = {}
+
+    def try_reserve(self, path: str, size: int, keep_free: int) -> bool:
+        """
+        Reserve space for a file of ``size`` bytes at ``path``, provided that
+        at least ``keep_free`` bytes would remain free in the filesystem once
+        every outstanding reservation is fully written. Any part of the file
+        that already exists counts toward the reservation.
+
+        :return: Whether the reservation was made
+        """
+
+        with self._lock:
+            need = max(0, size - allocated_bytes(path))
+            if self._available() < need + keep_free:
+                return False
+            self._reserved[path] = size
+            return True
+
+    def release(self, path: str):
+        """Drop any reservation held for ``path``."""
+        with self._lock:
+            released = self._reserved.pop(path, None)
+        if released is not None:
+            self.on_release.dispatch()
+
+    def unlink(self, path: str):
+        """Remove the file at ``path`` if it exists, and announce the freed space."""
+        freed = allocated_bytes(path)
+        isopod.os.force_unlink(path)
+        if freed > 0:
+            log.info("Freed %d bytes from %s", freed, path)
+            self.on_release.dispatch()
+
+    def is_reserved(self, path: str) -> bool:
+        with self._lock:
+            return path in self._reserved
+
+    def available(self) -> int:
+        """
+        The number of free bytes in the filesystem, less the bytes that
+        outstanding reservations have yet to write.
+        """
+
+        with self._lock:
+            return self._available()
+
+    def _available(self) -> int:
+        outstanding = sum(
+            max(0, size - allocated_bytes(path))
+            for path, size in self._reserved.items()
+        )
+        return shutil.disk_usage(self.root).free - outstanding
+
+
+def allocated_bytes(path: str) -> int:
+    """The bytes of storage that the file at ``path`` takes up, if it exists."""
+    try:
+        return os.stat(path).st_blocks * 512
+    except FileNotFoundError:
+        return 0
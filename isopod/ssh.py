@@ -0,0 +1,135 @@
+import logging
+import os
+import shlex
+import shutil
+import tempfile
+import time
+from subprocess import DEVNULL, Popen
+from typing import Optional
+
+import isopod.os
+
+log = logging.getLogger(__name__)
+
+CONNECT_TIMEOUT_SEC = 30
+CHECK_TIMEOUT_SEC = 10
+CHECK_INTERVAL_SEC = 60
+
+
+class ControlMaster:
+    """
+    A long-lived OpenSSH master connection to ``host``, which other ssh
+    processes can share through :meth:`client_options` instead of each making
+    a connection of their own. Clients fall back to connecting on their own
+    whenever the master isn't up.
+
+    :param host: The host to connect to, as passed to ssh
+    :param check_interval: How often :meth:`check` asks the master whether
+        it's still answering, in seconds
+    """
+
+    def __init__(self, host: str, check_interval: float = CHECK_INTERVAL_SEC):
+        self.host = host
+        self.check_interval = check_interval
+        self.proc: Optional[Popen] = None
+        self._dir = tempfile.mkdtemp(prefix="isopod-ssh-")
+        self.control_path = os.path.join(self._dir, "control")
+        self._check: Optional[Popen] = None
+        self._started = 0.0
+        self._checked = 0.0
+
+    def start(self):
+        """Start a new master connection, replacing any existing one."""
+        self.stop()
+        args = [
+            "ssh",
+            "-M",
+            "-N",
+            "-S",
+            self.control_path,
+            "-o",
+            "BatchMode=yes",
+            "-o",
+            f"ConnectTimeout={CONNECT_TIMEOUT_SEC}",
+            "-o",
+            "ServerAliveInterval=15",
+            "-o",
+            "ServerAliveCountMax=3",
+            self.host,
+        ]
+        self.proc = Popen(args, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+        self._started = self._checked = time.monotonic()
+        log.info("Started: %s", shlex.join(args))
+
+    def healthy(self) -> bool:
+        """
+        Whether the master is running and hasn't failed its last check, which
+        :meth:`check` starts. Never waits on anything.
+        """
+
+        if self.proc is None or self.proc.poll() is not None:
+            return False
+        if self._check is None:
+            return True
+
+        match self._check.poll():
+            case None if time.monotonic() - self._checked < CHECK_TIMEOUT_SEC:
+                return True
+            case None:
+                log.info("SSH connection to %s isn't answering", self.host)
+                self._check.kill()
+                self._check.wait()
+                healthy = False
+            case returncode:
+                healthy = returncode == 0
+        self._check = None
+        return healthy
+
+    @property
+    def checking(self) -> bool:
+        """Whether a check is running, which :meth:`healthy` gives up on in time."""
+        return self._check is not None
+
+    def check(self) -> Optional[Popen]:
+        """
+        Start asking the master whether it's still answering on its control
+        socket, at most once every ``check_interval`` and only once it's had
+        time to connect. :meth:`healthy` picks up the answer once the returned
+        process exits.
+        """
+
+        if self.proc is None or self._check is not None:
+            return None
+        now = time.monotonic()
+        if now - self._started < CONNECT_TIMEOUT_SEC:
+            return None
+        if now - self._checked < self.check_interval:
+            return None
+
+        self._checked = now
+        args = ["ssh", "-S", self.control_path, "-O", "check", self.host]
+        self._check = Popen(args, stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+        return self._check
+
+    def stop(self):
+        if self._check is not None:
+            self._check.kill()
+            self._check.wait()
+            self._check = None
+        if self.proc is None:
+            return
+        self.proc.terminate()
+        self.proc.wait()
+        self.proc = None
+        # A master that was killed leaves its socket behind, which would keep
+        # the next one from listening there.
+        isopod.os.force_unlink(self.control_path)
+
+    def close(self):
+        """Stop the master and remove its control socket directory."""
+        self.stop()
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+    def client_options(self) -> list[str]:
+        """ssh options that use the master connection if it's up."""
+        return ["-o", f"ControlPath={self.control_path}", "-o", "ControlMaster=no"]
@@ -0,0 +1,137 @@
+import json
+import logging
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Optional, TextIO
+
+from isopod.controller import ReconcileTrace
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class _Summary:
+    reconciles: int = 0
+    polls: int = 0
+    total_duration: float = 0.0
+    max_duration: float = 0.0
+    max_latency: float = 0.0
+    results: Counter = field(default_factory=Counter)
+
+
+class SummaryLogger:
+    """
+    A trace hook that logs a summary of each controller's reconciles once
+    ``interval`` seconds have passed since the last summary. Summaries are
+    only written when a reconcile finishes, so idle controllers stay quiet.
+
+    :param interval: The minimum number of seconds between summaries
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = Lock()
+        self._summaries: dict[str, _Summary] = {}
+        self._last_report = time.monotonic()
+
+    def __call__(self, trace: ReconcileTrace):
+        with self._lock:
+            summary = self._summaries.setdefault(trace.name, _Summary())
+            summary.reconciles += 1
+            summary.polls += trace.polls
+            summary.total_duration += trace.duration
+            summary.max_duration = max(summary.max_duration, trace.duration)
+            summary.max_latency = max(summary.max_latency, trace.latency)
+            summary.results[_result_name(trace)] += 1
+
+            if trace.finished - self._last_report < self.interval:
+                return
+            summaries, self._summaries = self._summaries, {}
+            self._last_report = trace.finished
+
+        for name, summary in sorted(summaries.items()):
+            log.info(
+                "%s: %d reconcile(s) for %d poll(s), "
+                "mean %0.1f ms, max %0.1f ms, max latency %0.1f ms, results %s",
+                name,
+                summary.reconciles,
+                summary.polls,
+                1000 * summary.total_duration / summary.reconciles,
+                1000 * summary.max_duration,
+                1000 * summary.max_latency,
+                dict(summary.results),
+            )
+
+
+class ChromeTraceWriter:
+    """
+    A trace hook that writes every reconcile to a file in the Chrome trace
+    event format, for viewing in chrome://tracing or Perfetto. Each controller
+    gets its own track.
+
+    The file is a JSON array that is never closed, which trace viewers accept
+    so that the trace stays valid when Isopod is killed.
+
+    :param path: The file to write, which is replaced if it exists
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = Lock()
+        self._epoch = time.monotonic()
+        self._tids: dict[int, int] = {}
+        self._file: Optional[TextIO] = open(path, "w", encoding="utf8")
+        self._file.write("[\n")
+        self._file.flush()
+        log.info("Writing reconcile traces to %s", path)
+
+    def __call__(self, trace: ReconcileTrace):
+        with self._lock:
+            if self._file is None:
+                return
+
+            tid = self._tids.get(id(trace.controller))
+            if tid is None:
+                tid = self._tids[id(trace.controller)] = len(self._tids) + 1
+                self._write(
+                    name="thread_name",
+                    ph="M",
+                    tid=tid,
+                    args={"name": f"{trace.name} {tid}"},
+                )
+
+            self._write(
+                name=_result_name(trace),
+                cat="reconcile",
+                ph="X",
+                ts=self._micros(trace.started),
+                dur=self._micros(trace.finished) - self._micros(trace.started),
+                tid=tid,
+                args={
+                    "polls": trace.polls,
+                    "latency_ms": round(1000 * trace.latency, 3),
+                },
+            )
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _micros(self, t: float) -> int:
+        return int(1_000_000 * (t - self._epoch))
+
+    def _write(self, **event):
+        assert self._file is not None
+        event["pid"] = 1
+        self._file.write(json.dumps(event) + ",\n")
+
+
+def _result_name(trace: ReconcileTrace) -> str:
+    if trace.result is None:
+        return "Raised"
+    return type(trace.result).__name__
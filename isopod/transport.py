@@ -0,0 +1,283 @@
+import logging
+import os
+import select
+import socket
+import socketserver
+import time
+from abc import ABC, abstractmethod
+from typing import Optional
+
+from sqlalchemy import update
+
+from isopod import db
+from isopod.checksum import hash_file
+from isopod.controller import Process, ThreadJob
+
+log = logging.getLogger(__name__)
+
+# The stream protocol runs over a single TCP connection per file. The client
+# opens with a header line:
+#
+#     ISOPOD/1 PUT <size> <offset> <sha256 or -> <name>
+#
+# The receiver keeps what it has of the file as <name>.part, truncates it to
+# the offset the client asked to resume from (if it's that long), and replies
+# with the offset to send from:
+#
+#     OFFSET <offset>
+#
+# The client then streams the rest of the file. As the receiver syncs what it
+# has written to disk, it acknowledges it with "ACK <offset>", and once it has
+# the whole file (matching the SHA-256, if given) it renames it into place and
+# replies "DONE <size>". Any problem ends the exchange with "ERR <message>".
+MAGIC = "ISOPOD/1"
+DEFAULT_PORT = 11874
+SEND_SIZE = 8 * (1024**2)
+ACK_INTERVAL = 64 * (1024**2)
+SOCKET_TIMEOUT_SEC = 60
+MAX_LINE = 4096
+
+
+class Transport(ABC):
+    """
+    A way to send a disc's staged file to the target in place of rsync. Every
+    transport keeps ``Disc.send_offset`` up to date with how much of the file
+    the target has acknowledged, and resumes from there.
+    """
+
+    required_cmds: tuple[str, ...] = ()
+
+    @abstractmethod
+    def start(self, disc: db.Disc, bwlimit: Optional[int] = None) -> Process:
+        """
+        Start sending ``disc`` in the background. The process exits with status
+        0 if and only if the target has the whole file.
+
+        :param bwlimit: The rate limit in KiB per second, if any
+        """
+
+        pass
+
+
+def parse_address(target: str) -> tuple[str, int]:
+    """Split a stream target of the form ``host[:port]``."""
+    host, sep, port = target.rpartition(":")
+    if not sep:
+        return target, DEFAULT_PORT
+    return host.strip("[]"), int(port)
+
+
+class StreamTransport(Transport):
+    """
+    Sends files over the stream protocol to :func:`serve`, with
+    :func:`socket.sendfile` so that the data never passes through Python.
+
+    :param address: The receiver's host and port
+    """
+
+    def __init__(self, address: tuple[str, int]):
+        self.address = address
+
+    def start(self, disc: db.Disc, bwlimit: Optional[int] = None) -> Process:
+        return StreamJob(self.address, disc, bwlimit)
+
+
+class StreamJob(ThreadJob):
+    """Sends a disc's staged file over the stream protocol in a background thread."""
+
+    errors = (OSError, ValueError)
+
+    def __init__(
+        self, address: tuple[str, int], disc: db.Disc, bwlimit: Optional[int] = None
+    ):
+        self.address = address
+        self.disc = disc
+        self.bwlimit = bwlimit
+        self.sent = 0
+        super().__init__(f"Streaming {disc.staged_path}")
+
+        self._sock: Optional[socket.socket] = None
+        self._inbox = bytearray()
+        self._start()
+
+    def terminate(self):
+        super().terminate()
+        if (sock := self._sock) is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def _work(self) -> int:
+        try:
+            return self._send()
+        finally:
+            if self._sock is not None:
+                self._sock.close()
+
+    def _send(self) -> int:
+        path = self.disc.staged_path
+        size = os.path.getsize(path)
+        offset = min(self.disc.send_offset or 0, size)
+        # The receiver can only check the SHA-256 of an uncompressed ISO.
+        digest = self.disc.sha256 if self.disc.send_path is None else None
+
+        self._sock = socket.create_connection(self.address, SOCKET_TIMEOUT_SEC)
+        if self._stop.is_set():
+            return -15
+        name = os.path.basename(path)
+        header = f"{MAGIC} PUT {size} {offset} {digest or '-'} {name}\n"
+        self._sock.sendall(header.encode("utf8"))
+
+        reply = self._read_line()
+        if not reply.startswith("OFFSET "):
+            log.error("Receiver refused %s: %s", path, reply)
+            return 1
+        pos = int(reply.removeprefix("OFFSET "))
+        if pos != offset:
+            log.info("Receiver has %d bytes of %s, not %d", pos, path, offset)
+        self._ack(pos)
+        log.info("Streaming %s from byte %d of %d", path, pos, size)
+
+        start, start_pos = time.monotonic(), pos
+        with open(path, "rb") as f:
+            while pos < size:
+                if self._stop.is_set():
+                    return -15
+                pos += self._sock.sendfile(f, pos, min(SEND_SIZE, size - pos))
+                self.sent = pos - start_pos
+                self._handle_replies(block=False)
+                if self.bwlimit is not None:
+                    ahead = self.sent / (self.bwlimit * 1024) - (
+                        time.monotonic() - start
+                    )
+                    if ahead > 0:
+                        self._stop.wait(ahead)
+
+        # The receiver may take a while to hash the whole file before replying.
+        self._sock.settimeout(None)
+        while (result := self._handle_replies(block=True)) is None:
+            pass
+        return result
+
+    def _handle_replies(self, block: bool) -> Optional[int]:
+        """
+        Handle the replies the receiver has sent so far, waiting for one if
+        ``block``, and return the exit status once the exchange has ended.
+        """
+
+        while block or b"\n" in self._inbox or self._readable():
+            line = self._read_line()
+            block = False
+            match line.split(maxsplit=1):
+                case ["ACK", offset]:
+                    self._ack(int(offset))
+                case ["DONE", size]:
+                    self._ack(int(size))
+                    return 0
+                case ["ERR", *_]:
+                    message = line.removeprefix("ERR").strip()
+                    log.error("Receiver failed %s: %s", self.disc.path, message)
+                    return 1
+                case _:
+                    raise ValueError(f"Unexpected reply: {line!r}")
+        return None
+
+    def _readable(self) -> bool:
+        assert self._sock is not None
+        readable, _, _ = select.select([self._sock], [], [], 0)
+        return bool(readable)
+
+    def _read_line(self) -> str:
+        assert self._sock is not None
+        while (end := self._inbox.find(b"\n")) < 0:
+            if len(self._inbox) > MAX_LINE:
+                raise ValueError("Reply line too long")
+            if not (data := self._sock.recv(MAX_LINE)):
+                raise ConnectionError("Receiver closed the connection")
+            self._inbox += data
+        line = bytes(self._inbox[:end])
+        del self._inbox[: end + 1]
+        return line.decode("utf8", errors="replace")
+
+    def _ack(self, offset: int):
+        """Record that the target has the first ``offset`` bytes of the file."""
+        if offset == self.disc.send_offset:
+            return
+        self.disc.send_offset = offset
+        with db.Session() as session:
+            session.execute(
+                update(db.Disc)
+                .where(db.Disc.path == self.disc.path)
+                .values(send_offset=offset)
+            )
+            session.commit()
+
+
+def serve(directory: str, address: str = "", port: int = DEFAULT_PORT):
+    """
+    Receive files over the stream protocol into ``directory`` until
+    interrupted. This is a stand-in for a real target, for testing.
+    """
+
+    class Handler(socketserver.StreamRequestHandler):
+        timeout = SOCKET_TIMEOUT_SEC
+
+        def handle(self):
+            try:
+                _receive(directory, self.rfile, self.wfile)
+            except (OSError, ValueError) as e:
+                log.warn("Receive from %s failed: %s", self.client_address, e)
+
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    with socketserver.ThreadingTCPServer((address, port), Handler) as server:
+        log.info("Receiving into %s on %s", directory, server.server_address)
+        server.serve_forever()
+
+
+def _receive(directory: str, rfile, wfile):
+    def reply(line: str):
+        wfile.write(f"{line}\n".encode("utf8"))
+        wfile.flush()
+
+    header = rfile.readline(MAX_LINE).decode("utf8").rstrip("\n")
+    match header.split(maxsplit=5):
+        case [magic, "PUT", size, offset, digest, name] if magic == MAGIC:
+            size, offset = int(size), int(offset)
+        case _:
+            reply("ERR malformed header")
+            return
+    if name != os.path.basename(name) or name.startswith("."):
+        reply("ERR bad name")
+        return
+
+    final = os.path.join(directory, name)
+    part = f"{final}.part"
+    with open(part, "ab+") as f:
+        pos = min(offset, f.tell(), size)
+        f.truncate(pos)
+        reply(f"OFFSET {pos}")
+
+        last_ack = pos
+        while pos < size:
+            if not (data := rfile.read1(min(SEND_SIZE, size - pos))):
+                log.info("%s ended at byte %d of %d", name, pos, size)
+                return
+            f.write(data)
+            pos += len(data)
+            if pos - last_ack >= ACK_INTERVAL:
+                f.flush()
+                os.fsync(f.fileno())
+                reply(f"ACK {pos}")
+                last_ack = pos
+        f.flush()
+        os.fsync(f.fileno())
+
+    if digest != "-" and hash_file(part) != digest:
+        os.unlink(part)
+        reply("ERR SHA-256 mismatch")
+        return
+
+    os.replace(part, final)
+    reply(f"DONE {size}")
+    log.info("Received %s (%d bytes)", name, size)